@@ -31,6 +31,7 @@ def score(
     challenge: str = "census",
     n_permutations: int = None,
     verbose: bool = False,
+    private_cache: sdnist.metrics.kmarg_old.PrivateMarginalCache = None,
 ):
     """Computes the k-marginal score between `private_dataset` and `synthetic_dataset`.
 
@@ -42,6 +43,8 @@ def score(
     :param n_permutations: int: number of k-marginal permutations to use. By default, the number of
         permutations used corresponds to the default value of the chosen challenge.
     :param verbose: bool: print scoring steps and outputs
+    :param private_cache: PrivateMarginalCache: discretized private dataset and private
+        marginals to reuse between the scores of several synthetic datasets.
 
     :return: score object containing several score-related metrics.
     """
@@ -59,6 +62,7 @@ def score(
         loading_bar=True,
         discretize=True,
         bins=config[strs.BINS],
+        private_cache=private_cache,
         **config[strs.K_MARGINAL],
     )
     if n_permutations is not None:
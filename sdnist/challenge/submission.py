@@ -7,7 +7,7 @@ import pandas as pd
 import sdnist
 import sdnist.strs as strs
 from sdnist.load import load_dataset, TestDatasetName
-from sdnist.metrics.kmarg_old import CensusKMarginalScore
+from sdnist.metrics.kmarg_old import CensusKMarginalScore, PrivateMarginalCache
 
 from loguru import logger
 
@@ -79,18 +79,23 @@ def run(submission: Model,
 
     score_per_eps = []
 
+    # discretized private dataset and private marginals shared by the scores
+    # of all epsilon values
+    private_cache = PrivateMarginalCache()
+
     # use this CensusKMaringalScore instance for just saving collective report
     # of all individual census k-marginal runs for every epsilon value. This is
     # not used for computing score instead it just used for saving report data
     # for the visualization.
     report_kmarg = None
     if challenge == "census" and html:
-        report_kmarg = sdnist.metrics.kmarginal.CensusKMarginalScore(private,
-                                                                     private,
-                                                                     schema,
-                                                                     discretize=True,
-                                                                     bins=config[strs.BINS],
-                                                                     **config[strs.K_MARGINAL])
+        report_kmarg = CensusKMarginalScore(private,
+                                            private,
+                                            schema,
+                                            discretize=True,
+                                            bins=config[strs.BINS],
+                                            private_cache=private_cache,
+                                            **config[strs.K_MARGINAL])
 
     for eps in EPS:
         # Attempt to skip already computed scores
@@ -122,12 +127,12 @@ def run(submission: Model,
         # Compute score
         logger.info(f"Computing scores for eps={eps}.")
 
-        # TODO score object can be reused for marginal speed gains.
         score = sdnist.score(private_dataset=private,
                              synthetic_dataset=synthetic,
                              schema=schema,
                              config=config,
-                             challenge=challenge)
+                             challenge=challenge,
+                             private_cache=private_cache)
         logger.success(f"eps={eps}\tscore={score.score:.2f}")
 
         if results is not None:
@@ -2,30 +2,135 @@
 Author: Mary Ann Wall
 """
 import argparse
+from collections import Counter
 from pathlib import Path
+from typing import List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+from sdnist.metrics.encoding import QuasiIdentifierGroups, feature_codes
 
-def cellchange(df1, df2, quasi, exclude_cols):
-    # use drop duplicates with keep argument as False,
-    # to retain only those records that occur only
-    # once in the data.
-    uniques1 = df1.drop_duplicates(subset=quasi, keep=False)
-    uniques2 = df2.drop_duplicates(subset=quasi, keep=False)
-    matcheduniq = uniques1.merge(uniques2, how='inner', on=quasi)
+
+def unique_rows(key: np.ndarray) -> np.ndarray:
+    """Positions of the keys that occur only once."""
+    _, inverse, counts = np.unique(key, return_inverse=True, return_counts=True)
+    return np.flatnonzero(counts[inverse] == 1)
+
+
+def unique_quasi_matches(df1: pd.DataFrame, df2: pd.DataFrame, quasi: List[str],
+                         qid_groups: Optional[QuasiIdentifierGroups] = None) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Records unique on the quasi-identifiers in each dataset, and their matches.
+    :param qid_groups: quasi-identifier partitions of the records of df1 and
+        df2, shared by several calls
+    :return: positions of the unique records of df1 and of df2, and positions
+        in df1 and in df2 of the unique records with equal quasi-identifiers,
+        in the order of df1
+    """
+    n1 = df1.shape[0]
+    if qid_groups is None:
+        qid_groups = QuasiIdentifierGroups(lambda f: feature_codes([df1, df2], f))
+    # quasi-identifier group of each record, missing values are a value of their own
+    key, _ = qid_groups.groups(tuple(quasi))
+    uniques1, uniques2 = unique_rows(key[:n1]), unique_rows(key[n1:])
+
+    # join the unique records on their quasi-identifier key
+    key1, key2 = key[uniques1], key[n1:][uniques2]
+    order2 = np.argsort(key2)
+    pos = np.minimum(np.searchsorted(key2[order2], key1), max(len(key2) - 1, 0))
+    found = key2[order2][pos] == key1 if len(key2) else np.zeros(len(key1), dtype=bool)
+    return uniques1, uniques2, uniques1[found], uniques2[order2[pos[found]]]
+
+
+def apparent_match_percents(df1: pd.DataFrame, df2: pd.DataFrame, cols: List[str],
+                            rows1: np.ndarray, rows2: np.ndarray) -> pd.Series:
+    """
+    Percent of the cols with equal values in each pair of records at positions
+    rows1 of df1 and rows2 of df2. Missing values are not equal.
+    """
+    # codes of the values of the matched records only, shared by both datasets
+    m1, m2 = df1.iloc[rows1], df2.iloc[rows2]
+    codes = np.array([feature_codes([m1, m2], c)[0] for c in cols])
+    codes = codes.reshape(len(cols), len(rows1) + len(rows2))
+    x, y = codes[:, :len(rows1)], codes[:, len(rows1):]
+    S = ((x == y) & (x >= 0)).sum(axis=0)
+    return pd.Series(S / len(cols) * 100)
+
+
+def matched_records(df1: pd.DataFrame, df2: pd.DataFrame, quasi: List[str],
+                    rows1: np.ndarray, rows2: np.ndarray) -> pd.DataFrame:
+    """
+    Pairs of records at positions rows1 of df1 and rows2 of df2, with equal
+    quasi-identifiers, as in df1.merge(df2, on=quasi): other columns of both
+    datasets get the _x and _y suffixes.
+    """
+    left = df1.iloc[rows1].reset_index(drop=True)
+    right = df2.iloc[rows2].drop(columns=quasi).reset_index(drop=True)
+    common = set(left.columns).intersection(right.columns)
+    left = left.rename(columns={c: c + "_x" for c in common})
+    right = right.rename(columns={c: c + "_y" for c in common})
+    return pd.concat([left, right], axis=1)
+
+
+def compared_columns(df1: pd.DataFrame, df2: pd.DataFrame,
+                     quasi: List[str], exclude_cols: List[str]) -> List[str]:
     allcols = set(df1.columns).intersection(set(df2.columns))
-    cols = allcols - set(quasi) - set(exclude_cols)
-    return match(matcheduniq, cols), uniques1, uniques2, matcheduniq
+    return sorted(allcols - set(quasi) - set(exclude_cols))
+
+
+def quasi_set_matches(df1: pd.DataFrame, df2: pd.DataFrame,
+                      quasi_sets: List[List[str]], exclude_cols: List[str]) \
+        -> List[Tuple[pd.Series, np.ndarray, np.ndarray]]:
+    """
+    Apparent matches of several quasi-identifier sets, e.g. of several adversary
+    models. The features are encoded once for all the sets, and quasi-identifier
+    partitions of sets sharing features are refined from one another.
+    :return: for each set, the match percents, and the positions in df1 and df2
+        of the matched unique records
+    """
+    codes = dict()
+
+    def f_codes(f: str) -> Tuple[np.ndarray, int]:
+        if f not in codes:
+            codes[f] = feature_codes([df1, df2], f)
+        return codes[f]
+
+    qid_groups = QuasiIdentifierGroups(f_codes)
+    # features of more sets first, so that the sets share prefixes
+    n_sets = Counter(f for quasi in quasi_sets for f in set(quasi))
+    matches = []
+    for quasi in quasi_sets:
+        ordered = sorted(set(quasi), key=lambda f: (-n_sets[f], f))
+        _, _, rows1, rows2 = unique_quasi_matches(df1, df2, ordered, qid_groups)
+        cols = compared_columns(df1, df2, quasi, exclude_cols)
+        matches.append((apparent_match_percents(df1, df2, cols, rows1, rows2),
+                        rows1, rows2))
+    return matches
+
+
+def cellchange(df1, df2, quasi, exclude_cols):
+    # records that occur only once in the data on the quasi-identifiers,
+    # and pairs of them with equal quasi-identifiers
+    uniques1, uniques2, rows1, rows2 = unique_quasi_matches(df1, df2, quasi)
+    cols = compared_columns(df1, df2, quasi, exclude_cols)
+    return apparent_match_percents(df1, df2, cols, rows1, rows2), \
+        df1.iloc[uniques1], df2.iloc[uniques2], \
+        matched_records(df1, df2, quasi, rows1, rows2)
 
 
 def match(df, cols):
-    S = pd.Series(data=0, index=df.index)
-    for c in cols:
-        c_x = c + "_x"
-        c_y = c + "_y"
-        S = S + (df[c_x] == df[c_y]).astype(int)
+    cols = list(cols)
+    x = df[[c + "_x" for c in cols]].to_numpy()
+    y = df[[c + "_y" for c in cols]].to_numpy()
+    # missing values are not equal, as in apparent_match_percents, and are not
+    # compared since pd.NA has no truth value
+    compared = ~(pd.isna(x) | pd.isna(y))
+    equal = np.zeros(x.shape, dtype=bool)
+    equal[compared] = x[compared] == y[compared]
+    S = pd.Series(data=equal.sum(axis=1), index=df.index)
     S = (S/len(cols)) * 100
     return S
 
@@ -0,0 +1,278 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from sdnist.utils import *
+
+# memory budget of the distances of one tile of records to one tile of records
+DCR_TILE_BYTES = 1 << 26
+# deidentified and held out records whose closest record distances are computed
+DCR_SAMPLE_ROWS = 10000
+
+
+class EncodedRecords:
+    """
+    Records of two datasets encoded for distance computations: codes of the
+    categorical features, shared by both datasets, with missing values as a
+    value of their own, and values of the numeric features scaled by their range,
+    the range of both datasets unless ranges are given.
+    """
+    def __init__(self,
+                 x: pd.DataFrame,
+                 y: pd.DataFrame,
+                 categorical_features: List[str],
+                 numeric_features: List[str],
+                 ranges: Optional[Dict[str, float]] = None):
+        n_x, n_rows = x.shape[0], x.shape[0] + y.shape[0]
+        self.n_features = len(categorical_features) + len(numeric_features)
+        codes, cards = [], []
+        for f in categorical_features:
+            c, uniques = pd.factorize(pd.concat([x[f], y[f]], ignore_index=True),
+                                      use_na_sentinel=False)
+            codes.append(c)
+            cards.append(len(uniques))
+        # positions of the features values in the one-hot encoding
+        self.offsets = np.cumsum([0] + cards[:-1]).astype(np.int64)
+        self.width = int(sum(cards))
+        codes = np.array(codes, dtype=np.int64).reshape(len(codes), n_rows).T + self.offsets
+        self.x_codes, self.y_codes = codes[:n_x], codes[n_x:]
+
+        values = np.array([pd.to_numeric(pd.concat([x[f], y[f]], ignore_index=True),
+                                         errors='coerce').values
+                           for f in numeric_features], dtype=np.float64)
+        values = values.reshape(len(numeric_features), n_rows).T
+        if ranges is not None:
+            values = values / np.array([ranges[f] for f in numeric_features])
+        elif len(numeric_features) and values.shape[0]:
+            f_ranges = np.nanmax(values, axis=0) - np.nanmin(values, axis=0)
+            f_ranges[~(f_ranges > 0)] = 1
+            values = values / f_ranges
+        values = values.astype(np.float32)
+        self.x_values, self.y_values = values[:n_x], values[n_x:]
+
+    def one_hot(self, codes: np.ndarray) -> np.ndarray:
+        oh = np.zeros((codes.shape[0], self.width), dtype=np.float32)
+        oh[np.arange(codes.shape[0])[:, None], codes] = 1
+        return oh
+
+
+def numeric_ranges(dfs: List[pd.DataFrame],
+                   numeric_features: List[str]) -> Dict[str, float]:
+    """Range of each numeric feature over all the datasets, 1 for constant features."""
+    ranges = dict()
+    for f in numeric_features:
+        values = pd.concat([pd.to_numeric(df[f], errors='coerce') for df in dfs])
+        r = values.max() - values.min()
+        ranges[f] = float(r) if r > 0 else 1.0
+    return ranges
+
+
+def tile_rows(tile_bytes: int) -> int:
+    # rows of square tiles, for the matches, the distances and one temporary array
+    return max(64, int(math.sqrt(tile_bytes / 12)))
+
+
+def closest_tile_distances(records: EncodedRecords,
+                           x_rows: slice,
+                           n_tile_rows: int) -> np.ndarray:
+    """
+    Distance of each record of a tile of x to its closest record in y: the
+    share of categorical features with different values plus the range scaled
+    absolute differences of numeric features, over the number of features.
+    """
+    x_codes, x_values = records.x_codes[x_rows], records.x_values[x_rows]
+    x_oh = records.one_hot(x_codes)
+    n_cat = x_codes.shape[1]
+    closest = np.full(x_codes.shape[0], np.inf, dtype=np.float32)
+    for start in range(0, records.y_codes.shape[0], n_tile_rows):
+        y_rows = slice(start, start + n_tile_rows)
+        # number of categorical features with different values, from the
+        # number of equal one-hot positions
+        dist = n_cat - x_oh @ records.one_hot(records.y_codes[y_rows]).T
+        for f in range(x_values.shape[1]):
+            x_f, y_f = x_values[:, f], records.y_values[y_rows, f]
+            diff = np.abs(x_f[:, None] - y_f[None, :])
+            if np.isnan(diff).any():
+                # missing values are equal to missing values only
+                both = np.isnan(x_f)[:, None] & np.isnan(y_f)[None, :]
+                diff = np.where(np.isnan(diff), np.where(both, 0, 1), diff)
+            dist += diff
+        np.minimum(closest, dist.min(axis=1), out=closest)
+    return closest / max(records.n_features, 1)
+
+
+def closest_record_distances(x: pd.DataFrame,
+                             y: pd.DataFrame,
+                             numeric_features: Optional[List[str]] = None,
+                             n_jobs: int = 1,
+                             tile_bytes: int = DCR_TILE_BYTES,
+                             ranges: Optional[Dict[str, float]] = None) -> np.ndarray:
+    """
+    Distance of each record of x to its closest record in y. The distance is
+    the Gower distance when there are numeric features, and the Hamming
+    distance, the share of features with different values, when all the
+    features are categorical. Numeric differences are scaled by ranges, or
+    by the ranges of x and y if not given.
+
+    Distances are computed in tiles of records of x and y whose distance
+    matrices fit in tile_bytes, with the tiles of x split across n_jobs
+    threads. Tile computations are numpy operations that release the GIL,
+    so threads share the encoded records without copies.
+    """
+    numeric_features = [f for f in (numeric_features or []) if f in x.columns]
+    categorical_features = [f for f in x.columns if f not in numeric_features]
+    records = EncodedRecords(x, y, categorical_features, numeric_features, ranges)
+    if x.shape[0] == 0 or y.shape[0] == 0:
+        return np.full(x.shape[0], np.nan)
+
+    n_tile_rows = tile_rows(tile_bytes)
+    x_tiles = [slice(start, start + n_tile_rows)
+               for start in range(0, x.shape[0], n_tile_rows)]
+    n_jobs = n_jobs if n_jobs > 0 else max(1, os.cpu_count() + 1 + n_jobs)
+    with ThreadPoolExecutor(max_workers=min(n_jobs, len(x_tiles))) as executor:
+        distances = executor.map(lambda rows: closest_tile_distances(records, rows,
+                                                                     n_tile_rows),
+                                 x_tiles)
+        return np.concatenate(list(distances))
+
+
+class DistanceToClosestRecord:
+    NAME = 'Distance to Closest Record'
+    quantiles = [0, 0.05, 0.25, 0.5, 0.75, 0.95]
+
+    def __init__(self,
+                 target: pd.DataFrame,
+                 synthetic: pd.DataFrame,
+                 output_directory: Path,
+                 numeric_features: Optional[List[str]] = None,
+                 holdout_frac: float = 0.5,
+                 seed: int = 0,
+                 n_jobs: int = 1,
+                 tile_bytes: int = DCR_TILE_BYTES,
+                 max_rows: Optional[int] = DCR_SAMPLE_ROWS):
+        """
+        Distance of each deidentified record to its closest target record.
+        As a baseline, the target data is split into held out records and
+        reference records: the distance of deidentified records to their
+        closest reference record is compared with the distance of held out
+        records to their closest reference record. Deidentified records much
+        closer to target records than real records are to each other may
+        disclose them.
+
+        Parameters
+        ----------
+            target : pd.Dataframe
+                target dataset
+            synthetic : pd.Dataframe
+                deidentified dataset
+            output_directory: Path
+                path of the directory to which results will be saved
+            numeric_features: List[str]
+                features compared by their range scaled absolute difference, for
+                the Gower distance. Without numeric features the distance is the
+                Hamming distance.
+            holdout_frac: float
+                fraction of the target records held out for the baseline, the
+                rest are the reference records
+            seed: int
+                seed of the holdout target records
+            n_jobs: int
+                number of threads the distances are computed in, -1 uses all the cpus
+            tile_bytes: int
+                memory budget of the distances of one tile of records
+            max_rows: int
+                maximum number of deidentified and of held out records whose
+                distances are computed, larger datasets are subsampled with the
+                seed. All the records are scored if None.
+        """
+        self.target = target
+        self.synthetic = synthetic[target.columns.tolist()]
+        self.numeric_features = [f for f in (numeric_features or [])
+                                 if f in target.columns]
+        self.holdout_frac = holdout_frac
+        self.seed = seed
+        self.n_jobs = n_jobs
+        self.tile_bytes = tile_bytes
+        self.max_rows = max_rows
+        self.o_dir = output_directory
+        self.o_path = Path(self.o_dir, 'dcr')
+        self.deid_dcr = np.zeros(0)  # closest target record distance of deid records
+        # closest reference record distance of deid and holdout records
+        self.deid_reference_dcr = np.zeros(0)
+        self.holdout_dcr = np.zeros(0)
+        self.dcr_dist = pd.DataFrame()  # quantiles of the distances
+        self.score = 0
+        self.report_data = dict()
+
+        self._setup()
+
+    def _setup(self):
+        if not self.o_dir.exists():
+            raise Exception(f'Path {self.o_dir} does not exist. Cannot save results')
+        if not self.o_path.exists():
+            os.mkdir(self.o_path)
+
+    def holdout_split(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Held out target records and the rest of the target records."""
+        rng = np.random.default_rng(self.seed)
+        rows = rng.permutation(self.target.shape[0])
+        n_holdout = int(round(self.target.shape[0] * self.holdout_frac))
+        return self.target.iloc[rows[:n_holdout]], self.target.iloc[rows[n_holdout:]]
+
+    def sample(self, data: pd.DataFrame) -> pd.DataFrame:
+        """Seeded subsample of max_rows records of data, in their order."""
+        if self.max_rows is None or data.shape[0] <= self.max_rows:
+            return data
+        rng = np.random.default_rng(self.seed)
+        rows = np.sort(rng.choice(data.shape[0], self.max_rows, replace=False))
+        return data.iloc[rows]
+
+    def compute_score(self) -> float:
+        holdout, reference = self.holdout_split()
+        deid = self.sample(self.synthetic)
+        # numeric differences are scaled alike in all the distances
+        ranges = numeric_ranges([self.target, self.synthetic], self.numeric_features)
+        args = (self.numeric_features, self.n_jobs, self.tile_bytes, ranges)
+        self.deid_reference_dcr = closest_record_distances(deid, reference,
+                                                           *args)
+        # closest of the closest reference and holdout records, in the whole target
+        self.deid_dcr = np.fmin(self.deid_reference_dcr,
+                                closest_record_distances(deid, holdout,
+                                                         *args))
+        self.holdout_dcr = closest_record_distances(self.sample(holdout), reference,
+                                                    *args)
+
+        self.dcr_dist = pd.DataFrame(
+            {'Deid. records to target records':
+                 np.quantile(self.deid_dcr, self.quantiles),
+             'Deid. records to reference records':
+                 np.quantile(self.deid_reference_dcr, self.quantiles),
+             'Holdout records to reference records':
+                 np.quantile(self.holdout_dcr, self.quantiles)},
+            index=pd.Index(self.quantiles, name='Quantile')
+        ).round(4)
+        # share of deidentified records closer to the reference records than
+        # 95% of the held out target records are
+        holdout_5th = np.quantile(self.holdout_dcr, 0.05)
+        self.score = float(np.mean(self.deid_reference_dcr < holdout_5th))
+
+        self.report_data = {
+            'distance': 'gower' if self.numeric_features else 'hamming',
+            'deid_records': len(self.deid_dcr),
+            'holdout_records': len(self.holdout_dcr),
+            'deid_median_dcr': float(np.median(self.deid_dcr)),
+            'deid_exact_match_fraction': float(np.mean(self.deid_dcr == 0)),
+            'deid_reference_median_dcr': float(np.median(self.deid_reference_dcr)),
+            'holdout_median_dcr': float(np.median(self.holdout_dcr)),
+            'holdout_exact_match_fraction': float(np.mean(self.holdout_dcr == 0)),
+            'deid_closer_than_holdout_5th_percentile': self.score,
+            'dcr_distribution': relative_path(save_data_frame(self.dcr_dist,
+                                                              self.o_path,
+                                                              'dist'))
+        }
+        return self.score
@@ -6,18 +6,25 @@ Reference:  Raab GM, Nowok B, and Dibben C. 2024. Practical privacy metrics for
 
 import argparse
 import itertools
+import math
 import os.path
 import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from pathlib import Path
 from pprint import pprint
 from tqdm import tqdm
-from typing import Dict, List, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
+from sdnist.metrics.encoding import \
+    QuasiIdentifierGroups, feature_codes, pack_quasi_identifiers, sample_marginals, \
+    share_codes
+
 # CONSTANTS
 DATASET_SIZE_THRESHOLD = 10000
 
@@ -29,13 +36,109 @@ def compute_quasi_identifiers(df: pd.DataFrame, q_identifiers: List[str]) -> pd.
     :param q_identifiers: The list of quasi-identifiers.
     :return: A pandas Series with the quasi-identifiers.
     """
-    return df[q_identifiers].apply(lambda row: "-".join(row.values.astype(str)), axis=1)
+    qid = df[q_identifiers[0]].astype(str)
+    for q in q_identifiers[1:]:
+        qid = qid + "-" + df[q].astype(str)
+    return qid
 
 
 def quasi_identifier_column_name(q_identifiers: List[str]) -> str:
     return "|".join(q_identifiers)
 
 
+def disco_dio_scores(
+    gt_key: np.ndarray,
+    syn_key: np.ndarray,
+    target_codes: List[Tuple[np.ndarray, int]],
+    n_groups: Optional[int] = None,
+) -> List[Tuple[float, float]]:
+    """
+    Computes the DiSCO and DiO metrics of several targets that share the
+    quasi-identifiers, from one table of distinct (quasi-identifier, target)
+    values per dataset.
+    :param gt_key: The quasi-identifier keys of the ground truth records.
+    :param syn_key: The quasi-identifier keys of the synthetic records.
+    :param target_codes: The codes of each target, ground truth records first,
+        and their number of distinct codes. Missing values get code -1.
+    :param n_groups: When given, the keys are group numbers in [0, n_groups).
+    :return: The DiSCO and DiO scores of each target.
+    """
+    n_gt = len(gt_key)
+    if n_gt == 0:
+        return [(0, 0)] * len(target_codes)
+
+    # Quasi-identifier group of each record, shared by both datasets
+    if n_groups is None:
+        _, group = np.unique(np.concatenate([gt_key, syn_key]), return_inverse=True)
+        n_groups = group.max() + 1 if len(group) else 0
+        gt_group, syn_group = group[:n_gt], group[n_gt:]
+    else:
+        gt_group, syn_group = gt_key, syn_key
+
+    # Target codes, one row per target, -1 for missing target values
+    n_targets = len(target_codes)
+    radix = max(card for _, card in target_codes) + 1
+    codes = np.stack([c for c, _ in target_codes])
+    gt_codes, syn_codes = codes[:, :n_gt], codes[:, n_gt:]
+
+    def single_valued(groups: np.ndarray, t_codes: np.ndarray) -> np.ndarray:
+        # Distinct (target, group, value) table, then the number of unique
+        # target values of each group. Missing values are not counted, as in nunique.
+        keys = [(i * n_groups + groups[c >= 0]) * radix + c[c >= 0]
+                for i, c in enumerate(t_codes)]
+        distinct = np.unique(np.concatenate(keys)) // radix
+        n_unique = np.bincount(distinct, minlength=n_targets * n_groups)
+        return n_unique.reshape(n_targets, n_groups) == 1
+
+    gt_single = single_valued(gt_group, gt_codes)
+    syn_single = single_valued(syn_group, syn_codes)
+
+    # First target value of each synthetic group, as in groupby(...).unique()[0]
+    syn_first = np.full((n_targets, n_groups), -1, dtype=np.int64)
+    present, first_idx = np.unique(syn_group, return_index=True)
+    syn_first[:, present] = syn_codes[:, first_idx]
+
+    scores = []
+    for i in range(n_targets):
+        # A ground truth record is disclosive if its target value is the
+        # value of its group in the synthetic data, when that group has one value.
+        disco_count = np.count_nonzero(
+            syn_single[i, gt_group]
+            & (gt_codes[i] == syn_first[i, gt_group])
+            & (gt_codes[i] >= 0)
+        )
+        # All records of groups with one target value are potentially disclosive.
+        dio_count = np.count_nonzero(gt_single[i, gt_group])
+        scores.append((disco_count / n_gt, dio_count / n_gt))
+    return scores
+
+
+def _shared_disco_dio(
+    shm_name: str,
+    shape: Tuple[int, int],
+    features: List[str],
+    cards: Dict[str, int],
+    n_gt: int,
+    qid_targets: List[Tuple[Tuple[str, ...], List[str]]],
+) -> List[List[Tuple[float, float]]]:
+    # worker process: DiSCO and DiO scores from the feature codes in shared memory
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        codes = np.ndarray(shape, dtype=np.int64, buffer=shm.buf)
+        f_idx = {f: i for i, f in enumerate(features)}
+        qid_groups = QuasiIdentifierGroups(lambda f: (codes[f_idx[f]], cards[f]))
+        scores = []
+        for qids, targets in qid_targets:
+            group, n_groups = qid_groups.groups(qids)
+            scores.append(disco_dio_scores(group[:n_gt], group[n_gt:],
+                                           [(codes[f_idx[t]], cards[t]) for t in targets],
+                                           n_groups))
+        return scores
+    finally:
+        del codes, qid_groups
+        shm.close()
+
+
 class KDiscoEvaluator:
     """
     DiSCO Metric
@@ -49,6 +152,9 @@ class KDiscoEvaluator:
         k: int = 2,
         output_directory: Union[str, Path] = "./output",
         create_dir: bool = True,
+        n_jobs: int = 1,
+        max_combinations: Optional[int] = None,
+        seed: int = 0,
     ) -> None:
         """
         Initializes the DiSCO metric.
@@ -58,11 +164,21 @@ class KDiscoEvaluator:
         :param k: The number of quasi-identifiers to consider (aside from the stable identifiers).
         :param output_directory: The output directory.
         :param create_dir: Whether to create the output directory.
+        :param n_jobs: The number of worker processes the quasi-identifier combinations
+            are split across. Negative values count back from the number of cpus,
+            -1 uses all of them. Scores do not depend on n_jobs.
+        :param max_combinations: The maximum number of combinations of k quasi-identifiers.
+            When there are more, max_combinations combinations are sampled and each is
+            scored against all the other targets.
+        :param seed: The seed of the sampled combinations.
         """
         self.gt_df = gt_df
         self.syn_df = syn_df
         self.stable_identifiers = stable_identifiers
         self.k = k
+        self.n_jobs = n_jobs if n_jobs > 0 else max(1, os.cpu_count() + 1 + n_jobs)
+        self.max_combinations = max_combinations
+        self.seed = seed
 
         # Get the column names
         self.gt_columns = gt_df.columns.tolist()
@@ -89,6 +205,36 @@ class KDiscoEvaluator:
         if create_dir and not os.path.exists(output_directory):
             os.makedirs(output_directory)
 
+        # Integer codes of each feature, shared by ground truth and synthetic data
+        self._feature_codes: Dict[str, Tuple[np.ndarray, int]] = {}
+        # Quasi-identifier partitions, refined one feature at a time
+        self._qid_groups = QuasiIdentifierGroups(self.feature_codes)
+
+    def quasi_identifier_keys(
+        self, quasi_identifiers: List[str]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Computes integer quasi-identifier keys of the ground truth and synthetic
+        records. Records have equal keys if they have equal quasi-identifier values.
+        :param quasi_identifiers: The quasi-identifiers.
+        :returns: The ground truth keys and the synthetic keys.
+        """
+        # missing values are a quasi-identifier value of their own, code 0
+        codes = [self.feature_codes(q) for q in quasi_identifiers]
+        key = pack_quasi_identifiers([c + 1 for c, _ in codes],
+                                     [card + 1 for _, card in codes])
+        n_gt = self.gt_df.shape[0]
+        return key[:n_gt], key[n_gt:]
+
+    def feature_codes(self, feature: str) -> Tuple[np.ndarray, int]:
+        """
+        Integer codes of a feature, ground truth records first, and the number
+        of distinct codes. Missing values get code -1.
+        """
+        if feature not in self._feature_codes:
+            self._feature_codes[feature] = feature_codes([self.gt_df, self.syn_df], feature)
+        return self._feature_codes[feature]
+
     def compute_disco(self, quasi_identifiers: List[str], target: str) -> float:
         """
         Computes the DiSCO metric.
@@ -96,46 +242,84 @@ class KDiscoEvaluator:
         :param quasi_identifiers: The quasi-identifiers.
         :returns: The calculated DiSCO score for the target column.
         """
-        qid_colname = quasi_identifier_column_name(sorted(quasi_identifiers))
-
-        if qid_colname not in self.syn_df.columns:
-            self.syn_df[qid_colname] = compute_quasi_identifiers(
-                self.syn_df, quasi_identifiers
-            )
-
-        if qid_colname not in self.gt_df.columns:
-            self.gt_df[qid_colname] = compute_quasi_identifiers(
-                self.gt_df, quasi_identifiers
-            )
+        # Quasi-identifier keys are computed for this call only, not added to the data
+        gt_key, syn_key = self.quasi_identifier_keys(sorted(quasi_identifiers))
 
         # Group by quasi-identifier, then find the number of unique targets within those groups in the synthetic data.
-        syn_unique = self.syn_df.groupby(qid_colname)[target].transform("nunique") == 1
-
-        # Filter synthetic data to keep only potentially disclosive records.
-        disclosive_in_synthetic = self.syn_df[syn_unique]
-
-        # Get a mapping of quasi-identifiers to values for our disclosive(unique) combinations
-        dis_mapping = (
-            disclosive_in_synthetic.groupby(qid_colname)[target].unique().to_dict()
-        )
-
-        # Filter the ground truth data on disclosive quasi-identifiers found in the synthetic data.
-        potential_disclosive_in_gt = self.gt_df[
-            self.gt_df[qid_colname].isin(disclosive_in_synthetic[qid_colname])
-        ]
+        syn_unique = (
+            self.syn_df[target].groupby(syn_key).transform("nunique") == 1
+        ).values
+
+        # Keep only potentially disclosive synthetic records, and get a mapping of
+        # quasi-identifiers to values for our disclosive(unique) combinations,
+        # the first target value of each group as in groupby(...).unique()[0]
+        dis_key = syn_key[syn_unique]
+        dis_target = self.syn_df[target].values[syn_unique]
+        dis_key, first_idx = np.unique(dis_key, return_index=True)
+        dis_mapping = pd.Series(dis_target[first_idx], index=dis_key)
+
+        # Synthetic disclosive target value of each ground truth record, NaN for records
+        # whose quasi-identifiers are not disclosive in the synthetic data.
+        gt_dis_target = pd.Series(gt_key, index=self.gt_df.index).map(dis_mapping)
 
         # If the ground truth target value matches our disclosive synthetic data,
         # this record should be counted as Disclosive.
-        gt_target_match = potential_disclosive_in_gt.apply(
-            lambda x: x[target] == dis_mapping[x[qid_colname]][0], axis=1
-        )
-        disco_count = (
-            gt_target_match[gt_target_match == True].count()  # noqa: E712
-            if gt_target_match.shape[0] > 0
-            else 0
-        )
+        gt_target_match = self.gt_df[target] == gt_dis_target
+        disco_count = gt_target_match.sum()
         return disco_count / self.gt_df.shape[0] if self.gt_df.shape[0] > 0 else 0
 
+    def compute_disco_dio(
+        self, quasi_identifiers: List[str], targets: List[str]
+    ) -> Dict[str, Tuple[float, float]]:
+        """
+        Computes the DiSCO and DiO metrics of several targets that share the
+        quasi-identifiers, from one table of distinct (quasi-identifier, target)
+        values per dataset. Results are those of compute_disco and compute_dio.
+        The quasi-identifier partition is refined from the cached partition of
+        quasi_identifiers[:-1] when there is one.
+        :param quasi_identifiers: The quasi-identifiers.
+        :param targets: The target columns.
+        :returns: The DiSCO and DiO scores of each target column.
+        """
+        group, n_groups = self._qid_groups.groups(tuple(quasi_identifiers))
+        n_gt = self.gt_df.shape[0]
+        target_codes = [self.feature_codes(t) for t in targets]
+        return dict(zip(targets, disco_dio_scores(group[:n_gt], group[n_gt:],
+                                                  target_codes, n_groups)))
+
+    def shared_disco_dio(
+        self, qid_targets: List[Tuple[Tuple[str, ...], List[str]]]
+    ) -> Dict[Tuple[str, ...], Dict[str, Tuple[float, float]]]:
+        """
+        Computes the DiSCO and DiO metrics of each quasi-identifier set and its
+        targets in n_jobs worker processes, that read the integer codes of the
+        features from shared memory. Results are those of compute_disco_dio.
+        :param qid_targets: The quasi-identifier sets and their target columns.
+        :returns: The DiSCO and DiO scores of each target column of each
+            quasi-identifier set.
+        """
+        features = sorted({f for qids, targets in qid_targets for f in [*qids, *targets]})
+        codes = [self.feature_codes(f) for f in features]
+        cards = {f: card for f, (_, card) in zip(features, codes)}
+        shm, shape = share_codes([c for c, _ in codes])
+        n_jobs = min(self.n_jobs, len(qid_targets))
+        # contiguous chunks, merged back in the order of qid_targets
+        chunks = np.array_split(np.arange(len(qid_targets)), n_jobs * 4)
+        try:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [executor.submit(_shared_disco_dio,
+                                           shm.name, shape, features, cards,
+                                           self.gt_df.shape[0],
+                                           [qid_targets[i] for i in c])
+                           for c in chunks if len(c)]
+                results = [s for f in tqdm(futures, desc="Compute DiSCO, DiO Scores")
+                           for s in f.result()]
+        finally:
+            shm.close()
+            shm.unlink()
+        return {qids: dict(zip(targets, scores))
+                for (qids, targets), scores in zip(qid_targets, results)}
+
     def compute_dio(self, quasi_identifiers: List[str], target: str) -> float:
         """
         Computes the DiO metric.
@@ -143,31 +327,19 @@ class KDiscoEvaluator:
         :param target: The target column to use for the calculation.
         :returns: The calculated DiO score for the selected dataframes.
         """
-        qid_colname = quasi_identifier_column_name(sorted(quasi_identifiers))
-
-        if qid_colname not in self.syn_df.columns:
-            self.syn_df[qid_colname] = compute_quasi_identifiers(
-                self.syn_df, quasi_identifiers
-            )
-
-        if qid_colname not in self.gt_df.columns:
-            self.gt_df[qid_colname] = compute_quasi_identifiers(
-                self.gt_df, quasi_identifiers
-            )
-
         # Base case: no data
         if self.gt_df.shape[0] == 0:
             return 0
 
+        gt_key, _ = self.quasi_identifier_keys(sorted(quasi_identifiers))
+
         # filter groups where target only has one value (groups that are potentially disclosive)
         disclosive_groups = (
-            self.gt_df.groupby(qid_colname)[target].transform("nunique") == 1
+            self.gt_df[target].groupby(gt_key).transform("nunique") == 1
         )
 
-        # filter records on potentially disclosive groups
-        disclosive_records = self.gt_df[disclosive_groups]
-
-        return disclosive_records.shape[0] / self.gt_df.shape[0]
+        # count records on potentially disclosive groups
+        return disclosive_groups.sum() / self.gt_df.shape[0]
 
     def compute_k_disco(self) -> None:
         """
@@ -207,64 +379,59 @@ class KDiscoEvaluator:
         if not potential_targets:
             raise ValueError(f"No potential targets found")
 
-        # --- Precompute QID columns ---
-
-        gt_new_cols = {}
-        syn_new_cols = {}
-        qid_combos = [(t, qid_combo)
-                      for t in potential_targets
-                      for qid_combo in itertools.combinations(
-                list(potential_targets - {t}), self.k)]
-        for target_col, qid_combo in tqdm(qid_combos,
-                                          desc="Precompute kDiSCO QID Columns"):
-            qids = tuple(sorted(stable_ids + list(qid_combo)))
-            qid_str = quasi_identifier_column_name(sorted(list(qids)))
-
-            if qid_str not in gt_new_cols:
-                gt_new_cols[qid_str] = compute_quasi_identifiers(self.gt_df,
-                                                                 list(qids))
-            if qid_str not in syn_new_cols:
-                syn_new_cols[qid_str] = compute_quasi_identifiers(
-                    self.syn_df, list(qids))
-
-        if gt_new_cols:
-            new_gt_df = pd.DataFrame(gt_new_cols, index=self.gt_df.index)
-            self.gt_df = pd.concat([self.gt_df, new_gt_df], axis=1)
-        if syn_new_cols:
-            new_syn_df = pd.DataFrame(syn_new_cols, index=self.syn_df.index)
-            self.syn_df = pd.concat([self.syn_df, new_syn_df], axis=1)
-
-        total_combinations = len(
-            [col for col in self.gt_df.columns if col.startswith("qid")]
-        )
+        # QID keys are computed on demand for each quasi-identifier set and discarded
+        # after scoring, only the integer codes of each feature are kept.
+        n_combinations = math.comb(len(potential_targets), self.k)
+        if self.max_combinations is not None and n_combinations > self.max_combinations:
+            # Sampled combinations, each scored against all the other targets
+            combos = sorted(itertools.islice(
+                sample_marginals(sorted(potential_targets), self.k, self.seed),
+                self.max_combinations))
+            qid_combos = [(t, qid_combo)
+                          for t in potential_targets
+                          for qid_combo in combos if t not in qid_combo]
+        else:
+            qid_combos = [(t, qid_combo)
+                          for t in potential_targets
+                          for qid_combo in itertools.combinations(
+                    list(potential_targets - {t}), self.k)]
+
         total_computed = 0
 
         # --- Compute DiSCO, DiO scores ---
-        for target_col, qid_combo in tqdm(qid_combos,
-                                          desc="Compute DiSCO, DiO Scores"):
+        # Targets of each quasi-identifier set, scored together. Quasi-identifiers
+        # are ordered stable identifiers first, so that the partitions of sets
+        # sharing a prefix are refinements of one cached partition.
+        qid_targets: Dict[Tuple[str, ...], List[str]] = {}
+        for target_col, qid_combo in qid_combos:
+            qids = tuple(stable_ids) + tuple(sorted(qid_combo))
+            qid_targets.setdefault(qids, []).append(target_col)
+        qid_targets = dict(sorted(qid_targets.items()))
+
+        qid_scores: Dict[Tuple[str, ...], Dict[str, Tuple[float, float]]] = {}
+        if min(self.n_jobs, len(qid_targets)) > 1:
+            qid_scores = self.shared_disco_dio(list(qid_targets.items()))
+        else:
+            for qids, targets in tqdm(qid_targets.items(),
+                                      desc="Compute DiSCO, DiO Scores"):
+                compute_start_time = time.time()
+                qid_scores[qids] = self.compute_disco_dio(list(qids), targets)
+                if __name__ == "__main__":
+                    print(f"\t{list(qids)}: ({total_computed} / {len(qid_targets)})")
+                    print(f"\t\tTook {time.time() - compute_start_time} seconds")
+                    total_computed += 1
+        qid_scores = {tuple(sorted(qids)): scores for qids, scores in qid_scores.items()}
+
+        for target_col, qid_combo in qid_combos:
             # Initialize
             if target_col not in self.disco_metric_results:
                 self.disco_metric_results[target_col] = {}
                 self.dio_metric_results[target_col] = {}
                 self.disco_minus_dio_metric_results[target_col] = {}
 
-                if __name__ == "__main__":
-                    print(f"Computing disco scores for target: {target_col}")
-
             qids = list(stable_ids) + list(qid_combo)
-            if __name__ == "__main__":
-                print(f"\t{qids}: ({total_computed} / {total_combinations})")
-                total_computed += 1
-            compute_start_time = time.time()
-            disco_risk_metric = self.compute_disco(
-                quasi_identifiers=qids, target=target_col
-            )
-            dio_risk_metric = self.compute_dio(
-                quasi_identifiers=qids, target=target_col
-            )
-
-            if __name__ == "__main__":
-                print(f"\t\tTook {time.time() - compute_start_time} seconds")
+            disco_risk_metric, dio_risk_metric = \
+                qid_scores[tuple(sorted(qids))][target_col]
             self.disco_metric_results[target_col][tuple(sorted(qids))] = (
                 disco_risk_metric
             )
@@ -0,0 +1,142 @@
+"""
+Encodings of dataset features shared by the metrics: integer codes of the
+features, codes shared with worker processes, quasi-identifier keys and
+partitions, and sampled feature combinations.
+"""
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from typing import Callable, List, Tuple
+import math
+
+import numpy as np
+import pandas as pd
+
+# number of quasi-identifier partitions kept to be refined by more features
+GROUP_CACHE_SIZE = 8
+
+
+def feature_codes(dfs: List[pd.DataFrame], feature: str) -> Tuple[np.ndarray, int]:
+    """
+    Integer codes of a feature, shared by several dataframes.
+    :param dfs: The dataframes to encode the feature of.
+    :param feature: The feature to encode.
+    :return: The codes of the records of all the dataframes, one after the other,
+        and the number of distinct codes. Missing values get code -1.
+    """
+    codes, uniques = pd.factorize(
+        pd.concat([df[feature] for df in dfs], ignore_index=True)
+    )
+    return codes.astype(np.int64), len(uniques)
+
+
+def pack_quasi_identifiers(codes: List[np.ndarray], cards: List[int]) -> np.ndarray:
+    """
+    Computes mixed-radix integer quasi-identifier keys from feature codes.
+    When the key space does not fit in 64 bits, the partial key is re-coded
+    with pd.factorize before the next feature is added.
+    :param codes: The codes of each quasi-identifier feature.
+    :param cards: The number of distinct codes of each quasi-identifier feature.
+    :return: The quasi-identifier key of each record.
+    """
+    key = np.zeros(len(codes[0]), dtype=np.int64)
+    key_card = 1
+    for c, card in zip(codes, cards):
+        if key_card * card > np.iinfo(np.int64).max:
+            key, uniques = pd.factorize(key)
+            key_card = len(uniques)
+        key = key * card + c
+        key_card *= card
+    return key
+
+
+def share_codes(codes: List[np.ndarray]) \
+        -> Tuple[shared_memory.SharedMemory, Tuple[int, int]]:
+    """Copy codes of several features into a (features, records) shared array."""
+    shape = (len(codes), len(codes[0]))
+    shm = shared_memory.SharedMemory(create=True,
+                                     size=max(1, shape[0] * shape[1] * 8))
+    arr = np.ndarray(shape, dtype=np.int64, buffer=shm.buf)
+    for i, c in enumerate(codes):
+        arr[i] = c
+    return shm, shape
+
+
+def sample_marginals(marginals: List[str], k: int, seed: int):
+    """
+    Distinct feature combinations of size k, in random order, sampled without
+    replacement until all the combinations have been drawn.
+    """
+    random_state = np.random.default_rng(seed=seed)
+    n_combinations = math.comb(len(marginals), k)
+    sampled = set()
+    while len(sampled) < n_combinations:
+        c = tuple(sorted(random_state.choice(len(marginals), size=k, replace=False)))
+        if c not in sampled:
+            sampled.add(c)
+            yield tuple(marginals[i] for i in c)
+
+
+def refine_groups(
+    groups: np.ndarray, n_groups: int, codes: np.ndarray, card: int
+) -> Tuple[np.ndarray, int]:
+    """
+    Refines a partition of the records by the values of one more feature.
+    :param groups: The group of each record, in [0, n_groups).
+    :param n_groups: The number of groups.
+    :param codes: The codes of the feature, -1 for missing values.
+    :param card: The number of distinct codes of the feature.
+    :return: The group of each record in the refined partition, numbered in
+        (group, code) order, and the number of groups.
+    """
+    # missing values are a quasi-identifier value of their own, code 0
+    key = groups * (card + 1) + (codes + 1)
+    size = n_groups * (card + 1)
+    if size <= max(4 * len(key), 1 << 16):
+        present = np.zeros(size, dtype=bool)
+        present[key] = True
+        remap = np.cumsum(present) - 1
+        return remap[key], int(remap[-1]) + 1
+    uniques, inverse = np.unique(key, return_inverse=True)
+    return inverse, len(uniques)
+
+
+class QuasiIdentifierGroups:
+    """
+    Partitions of the ground truth and synthetic records by their quasi-identifier
+    values. The partition of a list of quasi-identifiers is the refinement of the
+    partition of the list without its last feature, and recent partitions are kept
+    in a bounded LRU cache, so that lists sharing a prefix are refined from one
+    another instead of being computed from scratch.
+    """
+
+    def __init__(
+        self,
+        feature_codes: Callable[[str], Tuple[np.ndarray, int]],
+        max_size: int = GROUP_CACHE_SIZE,
+    ) -> None:
+        """
+        :param feature_codes: The codes of a feature, ground truth records first,
+            and the number of distinct codes. Missing values get code -1.
+        :param max_size: The number of partitions kept in the cache.
+        """
+        self.feature_codes = feature_codes
+        self.max_size = max_size
+        self._groups: OrderedDict = OrderedDict()
+
+    def groups(self, quasi_identifiers: Tuple[str, ...]) -> Tuple[np.ndarray, int]:
+        """
+        The quasi-identifier group of each record and the number of groups.
+        Groups may be empty.
+        """
+        if quasi_identifiers in self._groups:
+            self._groups.move_to_end(quasi_identifiers)
+            return self._groups[quasi_identifiers]
+        codes, card = self.feature_codes(quasi_identifiers[-1])
+        if len(quasi_identifiers) == 1:
+            partition = codes + 1, card + 1
+        else:
+            partition = refine_groups(*self.groups(quasi_identifiers[:-1]), codes, card)
+        self._groups[quasi_identifiers] = partition
+        if len(self._groups) > self.max_size:
+            self._groups.popitem(last=False)
+        return partition
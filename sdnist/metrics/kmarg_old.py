@@ -21,6 +21,19 @@ def compute_marginal_grouped(df, columns, groups):
     return counts / counts.groupby(groups).transform("sum")
 
 
+class PrivateMarginalCache:
+    """
+    Discretized private dataset and its marginals, shared by the scorers of
+    several synthetic datasets against the same private dataset, e.g. the
+    synthetic datasets of each epsilon of a challenge run. Use one instance per
+    private dataset, schema and bins.
+    """
+    def __init__(self):
+        self.private_dataset: Optional[pd.DataFrame] = None
+        # private marginals keyed by (group features, marginal columns)
+        self.marginals: Dict = {}
+
+
 class KMarginalScore:
     NAME = 'K-Marginal'
 
@@ -37,7 +50,8 @@ class KMarginalScore:
                  group_features: Optional[List[str]] = None,
                  ignore_features: Optional[List[str]] = None,
                  bias_penalty_cutoff: Optional[int] = None,
-                 loading_bar: bool = False):
+                 loading_bar: bool = False,
+                 private_cache: Optional[PrivateMarginalCache] = None):
         self.BINS = bins
         self.ALWAYS_GROUPBY = group_features or []
         self.drop_columns = ignore_features or []
@@ -51,8 +65,13 @@ class KMarginalScore:
             raise ValueError("The columns of the synthetic dataset does not match the columns of the score")
 
         self.BIAS_PENALTY_CUTOFF = bias_penalty_cutoff
+        self.private_cache = private_cache if private_cache is not None \
+            else PrivateMarginalCache()
         if discretize:
-            self._private_dataset = sdnist.utils.discretize(private_dataset, schema, self.BINS)
+            if self.private_cache.private_dataset is None:
+                self.private_cache.private_dataset = \
+                    sdnist.utils.discretize(private_dataset, schema, self.BINS)
+            self._private_dataset = self.private_cache.private_dataset
             self._synthetic_dataset = sdnist.utils.discretize(synthetic_dataset, schema, self.BINS)
         else:
             self._private_dataset = private_dataset
@@ -65,7 +84,7 @@ class KMarginalScore:
         self.seed = seed if seed is not None else 12345
 
         # Cache
-        self._p0_cache = {}  # cache for private dataset marginal
+        self._p0_cache = self.private_cache.marginals  # cache for private dataset marginal
 
     def __str__(self):
         if self.score is not None:
@@ -100,7 +119,7 @@ class KMarginalScore:
             c_list = self.columns()
 
         for columns in c_list:
-            idx = tuple(columns)
+            idx = (tuple(self.ALWAYS_GROUPBY), tuple(columns))
             if idx not in self._p0_cache:
                 self._p0_cache[idx] = compute_marginal_grouped(self._private_dataset, columns,
                                                                self.ALWAYS_GROUPBY)
@@ -150,7 +169,11 @@ class KMarginalScore:
             c_list = self.columns()
         # Compute KMarginal per group in ALWAYS_GROUPBY
         for columns in c_list:
-            p0 = compute_marginal(self._private_dataset, columns)
+            idx = ((), tuple(columns))
+            if idx not in self._p0_cache:
+                self._p0_cache[idx] = compute_marginal(self._private_dataset, columns)
+
+            p0 = self._p0_cache[idx]
             p1 = compute_marginal(self._synthetic_dataset, columns)
             tv = p0.subtract(p1, fill_value=0).abs().sum()
 
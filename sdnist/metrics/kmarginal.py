@@ -1,11 +1,299 @@
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from multiprocessing import shared_memory
+import hashlib
+import itertools
+import math
+import os
 import pandas as pd
 import numpy as np
 
+from sdnist.metrics.encoding import sample_marginals, share_codes
+
+# largest number of cells for which a marginal is counted into a dense
+# vector with np.bincount; bigger marginals fall back to sorted unique keys
+DENSE_MARGINAL_LIMIT = 1 << 24
+# marginals with more cells than this many per record are also counted with
+# sorted unique keys, the dense vector would be mostly empty
+DENSE_CELLS_PER_RECORD = 8
+# largest number of k-marginals scored with all the feature combinations, above
+# it combinations are sampled
+MAX_MARGINALS = 1000
+
+
 def compute_marginal_densities(data, marginals):
     counts = data.groupby(marginals).size()
     return counts / data.shape[0]
 
+
+def pack_keys(codes: List[np.ndarray], cards: List[int]) -> np.ndarray:
+    """
+    Pack codes of several features into one integer key per record, such that
+    keys sort in the lexicographic order of the codes: a * card_b + b.
+    Records with a missing value in any feature get key -1.
+    """
+    if math.prod(cards) > np.iinfo(np.int64).max:
+        raise ValueError(f'Marginal with feature cardinalities {cards} '
+                         f'has too many cells to pack in 64-bit keys')
+    key = np.zeros(len(codes[0]), dtype=np.int64)
+    missing = np.zeros(len(codes[0]), dtype=bool)
+    for c, card in zip(codes, cards):
+        key = key * card + c
+        missing |= c < 0
+    key[missing] = -1
+    return key
+
+
+def unpack_keys(keys: np.ndarray, cards: List[int]) -> List[np.ndarray]:
+    """Inverse of pack_keys for keys of records without missing values."""
+    codes = []
+    for card in reversed(cards):
+        codes.append(keys % card)
+        keys = keys // card
+    return codes[::-1]
+
+
+def key_counts(key: np.ndarray, size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Count records per packed key.
+    :param key: packed keys of the records
+    :param size: number of possible keys
+    :return: sorted keys present in the records, and count of each key
+    """
+    key = key[key >= 0]
+    if size <= DENSE_MARGINAL_LIMIT and \
+            size <= max(len(key) * DENSE_CELLS_PER_RECORD, 1 << 16):
+        counts = np.bincount(key, minlength=size)
+        cells = np.flatnonzero(counts)
+        return cells, counts[cells]
+    return np.unique(key, return_counts=True)
+
+
+def joint_counts(t_cells: np.ndarray, t_counts: np.ndarray,
+                 s_cells: np.ndarray, s_counts: np.ndarray) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Align target and deidentified key counts on the union of their keys.
+    :return: sorted keys present in either dataset, and the target and
+        deidentified counts of those keys
+    """
+    cells = np.union1d(t_cells, s_cells)
+    t_cnt = np.zeros(len(cells), dtype=np.int64)
+    s_cnt = np.zeros(len(cells), dtype=np.int64)
+    t_cnt[np.searchsorted(cells, t_cells)] = t_counts
+    s_cnt[np.searchsorted(cells, s_cells)] = s_counts
+    return cells, t_cnt, s_cnt
+
+
+def group_sum(values: np.ndarray, groups: np.ndarray, n_groups: int) -> np.ndarray:
+    # pandas groupby sum is used on the flat vectors, rather than
+    # np.bincount, because its compensated summation is what the scores
+    # have always been computed with. It sums each group in the order of
+    # its values, so many marginals can be summed in one call.
+    sums = pd.Series(values).groupby(groups, sort=True).sum()
+    return sums.reindex(range(n_groups), fill_value=0).values
+
+
+def marginal_tv_sums(marginal_counts: Callable,
+                     marginals: List[List[str]],
+                     cards: Dict[str, int],
+                     t_n: int,
+                     s_n: int,
+                     n_groups: int = 0) \
+        -> Tuple[List[float], Optional[np.ndarray], Optional[np.ndarray]]:
+    """
+    Sums of target and deidentified densities absolute differences of marginals.
+    :param marginal_counts: function that returns the cells, target counts and
+        deidentified counts of a marginal
+    :param marginals: marginals, with the group feature first if n_groups > 0
+    :param cards: number of values of each feature
+    :param t_n: number of target records
+    :param s_n: number of deidentified records
+    :param n_groups: number of group feature values, 0 if there is no group feature
+    :return: sum of densities absolute differences of each marginal and, with a
+        group feature, the sums of target densities and of densities absolute
+        differences in each group of each marginal, of shape (marginals, n_groups)
+    """
+    den_diff_sums = []
+    # target densities and densities absolute differences of the cells of
+    # all marginals, labelled with marginal index and group feature code
+    t_den_parts, t_label_parts, den_diff_parts, label_parts = [], [], [], []
+    for i, marg in enumerate(marginals):
+        cells, t_cnt, s_cnt = marginal_counts(marg)
+        # t_den: target data marginal densities
+        t_den = t_cnt / t_n
+        # abs_den_diff: target and deidentified densities absolute differences
+        abs_den_diff = np.abs(t_den - s_cnt / s_n)
+        # sum of target and deidentified densities absolute differences
+        den_diff_sums.append(abs_den_diff.sum())
+
+        if n_groups:
+            # group feature code of each marginal cell
+            cell_labels = i * n_groups + \
+                cells // int(np.prod([cards[f] for f in marg[1:]]))
+            t_present = t_cnt > 0
+            t_den_parts.append(t_den[t_present])
+            t_label_parts.append(cell_labels[t_present])
+            den_diff_parts.append(abs_den_diff)
+            label_parts.append(cell_labels)
+
+    if not n_groups:
+        return den_diff_sums, None, None
+    n_marg = len(marginals)
+    # get sum of target densities in each group of each marginal
+    group_t_den_sum = group_sum(np.concatenate(t_den_parts),
+                                np.concatenate(t_label_parts),
+                                n_marg * n_groups).reshape(n_marg, n_groups)
+    # sum density differences in each group of each marginal
+    group_den_sum = group_sum(np.concatenate(den_diff_parts),
+                              np.concatenate(label_parts),
+                              n_marg * n_groups).reshape(n_marg, n_groups)
+    return den_diff_sums, group_t_den_sum, group_den_sum
+
+
+def project_counts(codes: List[np.ndarray], cards: List[int],
+                   t_cnt: np.ndarray, s_cnt: np.ndarray,
+                   positions: List[int]) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Counts of a sub-marginal from the counts of a marginal, summed over the
+    features of the marginal that are not in positions.
+    :param codes: feature codes of the marginal cells, unpacked from cell keys
+    :param cards: number of values of each marginal feature
+    :param positions: positions of the sub-marginal features in the marginal
+    :return: sorted sub-marginal keys, and their target and deidentified counts
+    """
+    sub_cards = [cards[p] for p in positions]
+    key = pack_keys([codes[p] for p in positions], sub_cards)
+    size = int(np.prod(sub_cards, dtype=object))
+    if size <= DENSE_MARGINAL_LIMIT and \
+            size <= max(len(key) * DENSE_CELLS_PER_RECORD, 1 << 16):
+        t_sub = np.bincount(key, weights=t_cnt, minlength=size)
+        s_sub = np.bincount(key, weights=s_cnt, minlength=size)
+        sub_cells = np.flatnonzero((t_sub > 0) | (s_sub > 0))
+        t_sub, s_sub = t_sub[sub_cells], s_sub[sub_cells]
+    else:
+        sub_cells, inverse = np.unique(key, return_inverse=True)
+        t_sub = np.bincount(inverse, weights=t_cnt, minlength=len(sub_cells))
+        s_sub = np.bincount(inverse, weights=s_cnt, minlength=len(sub_cells))
+    return sub_cells, t_sub.astype(np.int64), s_sub.astype(np.int64)
+
+
+def multi_group_tv_sums(marginal_counts: Callable,
+                        pairs: Dict[int, Tuple[str, ...]],
+                        group_pairs: Dict[str, List[int]],
+                        cards: Dict[str, int],
+                        t_n: int,
+                        s_n: int):
+    """
+    marginal_tv_sums of several group features, each scored with its own
+    marginal pairs. Each pair is counted once, jointly with all the group
+    features that use it, and the marginal of each group feature and the pair
+    is summed from the joint counts.
+    :param pairs: marginal pairs to count, by pair index
+    :param group_pairs: indices of the marginal pairs of each group feature, in
+        scoring order. Indices missing from pairs are skipped.
+    :return: for each group feature, the indices of its counted pairs and the
+        marginal_tv_sums of the group feature and these pairs
+    """
+    group_counts = dict()
+    group_pair_sets = {g: set(g_pairs) for g, g_pairs in group_pairs.items()}
+    pair_groups = {i: [g for g, g_pairs in group_pair_sets.items() if i in g_pairs]
+                   for i in pairs}
+    for i, pair in pairs.items():
+        joint = list(dict.fromkeys(pair_groups[i] + list(pair)))
+        j_cards = [cards[f] for f in joint]
+        cells, t_cnt, s_cnt = marginal_counts(joint)
+        codes = unpack_keys(cells, j_cards)
+        for g in pair_groups[i]:
+            positions = [joint.index(f) for f in [g] + list(pair)]
+            group_counts[(g, i)] = project_counts(codes, j_cards, t_cnt, s_cnt,
+                                                  positions)
+
+    sums = dict()
+    for g, g_pairs in group_pairs.items():
+        # sampled pairs may be listed several times, and are summed as many
+        # times as KMarginal scores them
+        g_pairs = [i for i in g_pairs if i in pairs]
+        if not g_pairs:
+            empty = np.zeros((0, cards[g]))
+            sums[g] = (g_pairs, [], empty, empty)
+            continue
+        g_counts = iter([group_counts[(g, i)] for i in g_pairs])
+        sums[g] = (g_pairs, *marginal_tv_sums(lambda m: next(g_counts),
+                                              [[g] + list(pairs[i]) for i in g_pairs],
+                                              cards, t_n, s_n, cards[g]))
+    return sums
+
+
+def _shared_codes_call(t_shm_name: str, t_shape: Tuple[int, int],
+                       s_shm_name: str, s_shape: Tuple[int, int],
+                       features: List[str],
+                       cards: Dict[str, int],
+                       func: Callable,
+                       *args):
+    # worker process: call func with marginal counts of the codes in shared memory
+    t_shm = shared_memory.SharedMemory(name=t_shm_name)
+    s_shm = shared_memory.SharedMemory(name=s_shm_name)
+    try:
+        t_codes = np.ndarray(t_shape, dtype=np.int64, buffer=t_shm.buf)
+        s_codes = np.ndarray(s_shape, dtype=np.int64, buffer=s_shm.buf)
+        f_idx = {f: i for i, f in enumerate(features)}
+
+        def marginal_counts(marginal: List[str]):
+            m_cards = [cards[f] for f in marginal]
+            size = int(np.prod(m_cards, dtype=object))
+            t_key = pack_keys([t_codes[f_idx[f]] for f in marginal], m_cards)
+            s_key = pack_keys([s_codes[f_idx[f]] for f in marginal], m_cards)
+            return joint_counts(*key_counts(t_key, size), *key_counts(s_key, size))
+
+        return func(marginal_counts, *args)
+    finally:
+        del t_codes, s_codes
+        t_shm.close()
+        s_shm.close()
+
+
+class TargetMarginalCache:
+    """
+    Target data feature encodings and marginal counts, keyed by dataset
+    fingerprint and feature tuple, and filled lazily by KMarginal. Share one
+    instance between all the KMarginal instances that score against the same
+    target data so that each target marginal is counted only once.
+
+    Target features are encoded with the target values only, so that the
+    cached counts do not depend on the deidentified data they are compared with.
+    """
+    def __init__(self):
+        self._encodings: Dict[Tuple[str, str], Tuple[np.ndarray, pd.Index]] = dict()
+        self._counts: Dict[Tuple[str, Tuple[str, ...]],
+                           Tuple[np.ndarray, np.ndarray]] = dict()
+
+    @staticmethod
+    def fingerprint(data: pd.DataFrame) -> str:
+        h = hashlib.sha1(str(data.columns.tolist()).encode())
+        h.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+        return h.hexdigest()
+
+    def encoding(self, fingerprint: str, data: pd.DataFrame, feature: str) \
+            -> Tuple[np.ndarray, pd.Index]:
+        key = (fingerprint, feature)
+        if key not in self._encodings:
+            self._encodings[key] = pd.factorize(data[feature], sort=True)
+        return self._encodings[key]
+
+    def counts(self, fingerprint: str, data: pd.DataFrame, marginal: Tuple[str, ...]) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        key = (fingerprint, marginal)
+        if key not in self._counts:
+            encodings = [self.encoding(fingerprint, data, f) for f in marginal]
+            cards = [len(u) for _, u in encodings]
+            t_key = pack_keys([c for c, _ in encodings], cards)
+            self._counts[key] = key_counts(t_key, int(np.prod(cards, dtype=object)))
+        return self._counts[key]
+
+
 def get_marginal_pairs(marginals: List[str],
                        permutations: int,
                        seed: int):
@@ -21,6 +309,48 @@ def get_marginal_pairs(marginals: List[str],
             pair_marginals.append(list(random_state.choice(marginals, size=2)))
         return pair_marginals
 
+def marginals_sampled(n_features: int, k: int) -> bool:
+    """True if get_marginals samples the feature combinations of n_features."""
+    if k == 2:
+        return n_features >= 30
+    return n_features > k and math.comb(n_features, k) > MAX_MARGINALS
+
+
+def score_error(den_diff_sums: List[float], n_combinations: int) -> float:
+    """
+    Half-width of the 95% confidence interval of the 0 - 1000 score, from the
+    densities absolute differences sums of marginals sampled without replacement
+    out of n_combinations.
+    """
+    n = len(den_diff_sums)
+    if n >= n_combinations:
+        return 0.0
+    if n < 2:
+        return float('inf')
+    # standard error of the mean with finite population correction
+    se = np.std(den_diff_sums, ddof=1) / np.sqrt(n) \
+        * np.sqrt((n_combinations - n) / (n_combinations - 1))
+    return float(1.96 * 500 * se)
+
+
+def get_marginals(marginals: List[str],
+                  k: int,
+                  permutations: int,
+                  seed: int):
+    """
+    Feature combinations of the k-marginals. All the combinations are used when
+    there are at most MAX_MARGINALS of them, else permutations distinct
+    combinations are sampled. 2-marginals are the get_marginal_pairs.
+    """
+    if k == 2:
+        return get_marginal_pairs(marginals, permutations, seed)
+    if len(marginals) <= k:
+        return [tuple(marginals)]
+    if math.comb(len(marginals), k) <= MAX_MARGINALS:
+        return list(itertools.combinations(marginals, k))
+    return list(itertools.islice(sample_marginals(marginals, k, seed), permutations))
+
+
 class KMarginal:
     """
     [t1, t2, t3, t4] are target densities.   t1 = count / tN
@@ -56,54 +386,250 @@ class KMarginal:
     Because now the max will let you differ is by the size of the whole target data,
     and that means you max out at 1 (note, we should only do this for PUMA,
     because the target population size for every PUMA is reasonable)
+
+    With n_jobs > 1 the marginals are split across n_jobs worker processes that
+    read the integer coded target and deidentified data from shared memory.
+    Negative n_jobs count back from the number of cpus, -1 uses all of them.
+    Scores do not depend on n_jobs.
+
+    k sets the number of features of each marginal, 2 by default. Cells of
+    k-marginals are counted from sorted 64-bit packed keys of the records, so
+    only the cells present in the data are stored. When there are more than
+    MAX_MARGINALS feature combinations, N_PERMUTATIONS of them are sampled.
+    The group feature is added to each k-marginal as with 2-marginals.
+
+    With a tolerance, marginals that would be sampled (2-marginals of 30 or more
+    features, k-marginals of more than MAX_MARGINALS combinations) are instead
+    drawn without replacement, MIN_SAMPLED_MARGINALS first and then SAMPLE_BATCH
+    at a time, until the 95% confidence half-width of the score, score_error,
+    is within tolerance or all the combinations are scored. Only the error of
+    the overall score is bounded, group scores are averaged over the same
+    marginals.
+
+    marginals, if given, are the feature combinations scored, e.g. those of an
+    earlier adaptive run, so that scores of other data are computed on the same
+    marginals.
     """
     NAME = 'K-Marginal'
     N_PERMUTATIONS = 200
+    MIN_SAMPLED_MARGINALS = 30
+    SAMPLE_BATCH = 10
 
     def __init__(self,
                  target_data: pd.DataFrame,
                  deidentified_data: pd.DataFrame,
                  group_feature: Optional[str] = None,
-                 seed: int = 0):
+                 seed: int = 0,
+                 target_cache: Optional[TargetMarginalCache] = None,
+                 n_jobs: int = 1,
+                 k: int = 2,
+                 tolerance: Optional[float] = None,
+                 marginals: Optional[List[Tuple[str, ...]]] = None):
         self.td = target_data
         self.deid = deidentified_data
         self.group_features = [group_feature] if group_feature else []
         self.features = self.td.columns.tolist()
         marg_cols = list(set(self.features).difference(set(self.group_features)))
         marg_cols = sorted(marg_cols)
-        self.marginals = get_marginal_pairs(marg_cols, self.N_PERMUTATIONS, seed)
+        self.k = k
+        self.seed = seed
+        self.marg_cols = marg_cols
+        self.tolerance = tolerance
+        # adaptive: marginals are sampled while scoring until tolerance is reached
+        self.adaptive = marginals is None and tolerance is not None \
+            and marginals_sampled(len(marg_cols), k)
+        if marginals is not None:
+            self.marginals = list(marginals)
+        else:
+            self.marginals = [] if self.adaptive \
+                else get_marginals(marg_cols, k, self.N_PERMUTATIONS, seed)
+        # 95% confidence half-width of the score of adaptively sampled marginals
+        self.score_error: Optional[float] = None
+        self.target_cache = target_cache \
+            if target_cache is not None else TargetMarginalCache()
+        self.n_jobs = n_jobs if n_jobs > 0 else max(1, os.cpu_count() + 1 + n_jobs)
+        # worker processes and shared codes of the shared_codes_workers context
+        self._workers = None
 
     def marginal_pairs(self):
         for _ in self.marginals:
             yield list(_)
 
+    def marginal_features(self):
+        """Features of the group feature and the marginals, to encode."""
+        if self.adaptive:
+            # marginals are sampled while scoring, any feature may be used
+            return sorted(set(self.group_features).union(self.marg_cols))
+        return sorted(set(self.group_features).union(
+            *[set(m) for m in self.marginals]))
+
     def compute_score(self):
+        self._encode()
         if len(self.group_features):
             return self._compute_score_grouped()
         else:
             return self._compute_score()
 
-    def marginal_densities(self, data: pd.DataFrame, marginal: List[str]):
-        # target data marginal densities
-        t_den = compute_marginal_densities(self.td, marginal)
-        # deidentified data marginal densities
-        s_den = compute_marginal_densities(self.deid, marginal)
-        # target and deidentified densities absolute differences
-        abs_den_diff = t_den.subtract(s_den, fill_value=0).abs()
-        return t_den, s_den, abs_den_diff
+    def _encode(self):
+        features = self.marginal_features()
+        self.t_fingerprint = self.target_cache.fingerprint(self.td)
+        # t_remap: target code to code in the values of both datasets
+        self.t_codes, self.t_remap, self.s_codes, self.uniques = {}, {}, {}, {}
+        for f in features:
+            t_codes, t_uniques = self.target_cache.encoding(self.t_fingerprint,
+                                                            self.td, f)
+            codes, uniques = pd.factorize(
+                pd.concat([pd.Series(t_uniques), self.deid[f]], ignore_index=True),
+                sort=True)
+            self.t_codes[f] = t_codes
+            self.t_remap[f] = codes[:len(t_uniques)]
+            self.s_codes[f] = codes[len(t_uniques):]
+            self.uniques[f] = uniques
+        self.cards = {f: len(u) for f, u in self.uniques.items()}
+
+    def target_counts(self, marginal: List[str]):
+        """
+        Target record counts of each target cell of the marginal, with cell
+        keys in the codes shared with the deidentified data.
+        """
+        cards = [self.cards[f] for f in marginal]
+        t_cards = [len(self.t_remap[f]) for f in marginal]
+        t_cells, t_cnt = self.target_cache.counts(self.t_fingerprint,
+                                                  self.td, tuple(marginal))
+        # move cached target keys to the codes shared with deidentified data,
+        # remapping is monotonic so the keys stay sorted
+        t_cells = pack_keys([self.t_remap[f][c]
+                             for f, c in zip(marginal, unpack_keys(t_cells, t_cards))],
+                            cards)
+        return t_cells, t_cnt
+
+    def marginal_counts(self, marginal: List[str]):
+        """
+        Target and deidentified record counts of each cell of the marginal.
+        Only the cells present in at least one of the datasets are returned,
+        in the sorted order of the marginal feature values.
+        """
+        cards = [self.cards[f] for f in marginal]
+        t_cells, t_cnt = self.target_counts(marginal)
+        s_key = pack_keys([self.s_codes[f] for f in marginal], cards)
+        s_cells, s_cnt = key_counts(s_key, int(np.prod(cards, dtype=object)))
+        return joint_counts(t_cells, t_cnt, s_cells, s_cnt)
+
+    def marginal_tv_sums(self, marginals: List[List[str]], n_groups: int = 0):
+        """
+        marginal_tv_sums of the given marginals, computed in n_jobs worker
+        processes when n_jobs > 1.
+        """
+        t_n, s_n = self.td.shape[0], self.deid.shape[0]
+        n_jobs = min(self.n_jobs, len(marginals))
+        if n_jobs <= 1:
+            return marginal_tv_sums(self.marginal_counts, marginals, self.cards,
+                                    t_n, s_n, n_groups)
+
+        chunks = np.array_split(np.arange(len(marginals)), n_jobs)
+        results = self.map_shared_codes(marginal_tv_sums,
+                                        [([marginals[i] for i in c], self.cards,
+                                          t_n, s_n, n_groups)
+                                         for c in chunks])
+        # reduce chunk results in marginal order
+        den_diff_sums = [d for r in results for d in r[0]]
+        if not n_groups:
+            return den_diff_sums, None, None
+        return den_diff_sums, \
+            np.concatenate([r[1] for r in results]), \
+            np.concatenate([r[2] for r in results])
+
+    @contextmanager
+    def shared_codes_workers(self, n_workers: int):
+        """
+        Worker processes, and the integer coded target and deidentified data in
+        shared memory, reused by all the map_shared_codes calls of the context.
+        """
+        features = list(self.cards.keys())
+        # target codes in the codes shared with deidentified data
+        t_codes = [np.where(self.t_codes[f] >= 0,
+                            self.t_remap[f][self.t_codes[f]], -1)
+                   for f in features]
+        t_shm, t_shape = share_codes(t_codes)
+        s_shm, s_shape = share_codes([self.s_codes[f] for f in features])
+        try:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                self._workers = (executor, t_shm.name, t_shape,
+                                 s_shm.name, s_shape, features)
+                yield
+        finally:
+            self._workers = None
+            for shm in [t_shm, s_shm]:
+                shm.close()
+                shm.unlink()
+
+    def map_shared_codes(self, func: Callable, chunk_args: List[tuple]) -> list:
+        """
+        Call func(marginal_counts, *args) for each args of chunk_args in worker
+        processes, that count marginals from the integer coded target and
+        deidentified data in shared memory. Workers of the enclosing
+        shared_codes_workers context are used if any.
+        """
+        if self._workers is None:
+            with self.shared_codes_workers(len(chunk_args)):
+                return self.map_shared_codes(func, chunk_args)
+        executor, t_shm_name, t_shape, s_shm_name, s_shape, features = self._workers
+        futures = [executor.submit(_shared_codes_call,
+                                   t_shm_name, t_shape,
+                                   s_shm_name, s_shape,
+                                   features, self.cards,
+                                   func, *args)
+                   for args in chunk_args]
+        return [f.result() for f in futures]
+
+    def adaptive_tv_sums(self, n_groups: int = 0):
+        """
+        marginal_tv_sums of marginals sampled in batches until score_error is
+        within tolerance. The sampled marginals are stored in self.marginals.
+        """
+        gf = self.group_features
+        n_combinations = math.comb(len(self.marg_cols), self.k)
+        sampler = sample_marginals(self.marg_cols, self.k, self.seed)
+        self.marginals = []
+        den_diff_sums, group_t_den_sums, group_den_sums = [], [], []
+        batch_size = self.MIN_SAMPLED_MARGINALS
+        # one pool of workers and one copy of the shared codes for all the batches
+        workers = self.shared_codes_workers(self.n_jobs) if self.n_jobs > 1 \
+            else nullcontext()
+        with workers:
+            while True:
+                batch = list(itertools.islice(sampler, batch_size))
+                if len(batch):
+                    self.marginals.extend(batch)
+                    d_sums, g_t_sums, g_sums = \
+                        self.marginal_tv_sums([gf + list(m) for m in batch], n_groups)
+                    den_diff_sums.extend(d_sums)
+                    group_t_den_sums.append(g_t_sums)
+                    group_den_sums.append(g_sums)
+                self.score_error = score_error(den_diff_sums, n_combinations)
+                if len(batch) < batch_size or self.score_error <= self.tolerance:
+                    break
+                batch_size = self.SAMPLE_BATCH
+
+        if not n_groups:
+            return den_diff_sums, None, None
+        return den_diff_sums, \
+            np.concatenate(group_t_den_sums), np.concatenate(group_den_sums)
+
+    def score_tv_sums(self, n_groups: int = 0):
+        """marginal_tv_sums of the marginals of the score."""
+        if self.adaptive:
+            return self.adaptive_tv_sums(n_groups)
+        return self.marginal_tv_sums([self.group_features + m
+                                      for m in self.marginal_pairs()], n_groups)
 
     def _compute_score(self):
         # sum total of densities absolute differences over all marginals
         tdds = 0
 
-        # For each 2-marginal find sum of absolute density differences
-        for marg in self.marginal_pairs():
-            # t_den: target data marginal densities
-            # s_den: deidentified data marginal densities
-            # abs_den_diff: target and deidentified densities absolute differences
-            t_den, s_den, abs_den_diff = self.marginal_densities(self.td, marg)
-            # sum of target and deidentified densities absolute differences
-            den_diff_sum = abs_den_diff.sum()
+        # For each k-marginal find sum of absolute density differences
+        den_diff_sums, _, _ = self.score_tv_sums()
+        for den_diff_sum in den_diff_sums:
             tdds += den_diff_sum
 
         # find average of overall score and each group feature score
@@ -113,44 +639,333 @@ class KMarginal:
         return self.score
 
     def _compute_score_grouped(self):
-        # sum total of densities absolute differences over all marginals
-        tdds = 0
         gf = self.group_features
-        group_N = self.td.groupby(gf).size()
-        group_tdds = group_N * 0
-
-        # For each 2-marginal find sum of absolute density differences, and
+        # For each k-marginal find sum of absolute density differences, and
         # for group feature find sum of absolute density differences for each
         # feature value
-        for marg in self.marginal_pairs():
-            marg = gf + marg
-            # t_den: target data marginal densities
-            # s_den: deidentified data marginal densities
-            # abs_den_diff: target and deidentified densities absolute differences
-            t_den, s_den, abs_den_diff = self.marginal_densities(self.td, marg)
-
-            # get sum of abs densities differences for group feature
-            group_t_den_sum = t_den.groupby(gf).sum()
-            # sum density differences in each group
-            group_den_sum = abs_den_diff.groupby(gf).sum()
-            # take minimum of target density difference sum and group density difference sum
-            group_den_sum = group_t_den_sum.where(group_t_den_sum <= group_den_sum).fillna(group_den_sum)
-            # scale back group feature density different sums
-            group_den_scaled = (group_den_sum * len(self.td)) / group_N
-            # add this marginal's scaled density differences to other marginals aggregate
-            group_tdds = group_tdds + group_den_scaled
-
-            # sum of target and deidentified densities absolute differences
-            den_diff_sum = abs_den_diff.sum()
+        den_diff_sums, group_t_den_sum, group_den_sum = \
+            self.score_tv_sums(self.cards[gf[0]])
+        self.score, self.scores = self.grouped_scores(gf[0], den_diff_sums,
+                                                      group_t_den_sum, group_den_sum)
+        return self.score
+
+    def grouped_scores(self, group_feature: str,
+                       den_diff_sums: List[float],
+                       group_t_den_sum: np.ndarray,
+                       group_den_sum: np.ndarray) -> Tuple[float, pd.Series]:
+        """
+        Overall score and score of each group feature value, from the
+        marginal_tv_sums of the group feature marginals.
+        """
+        # sum total of densities absolute differences over all marginals
+        tdds = 0
+        n_marg = len(den_diff_sums)
+        t_n = self.td.shape[0]
+        t_group_codes = self.t_codes[group_feature]
+        group_N = np.bincount(t_group_codes[t_group_codes >= 0],
+                              minlength=len(self.t_remap[group_feature]))
+        # groups present in the target data
+        t_groups = self.t_remap[group_feature]
+
+        for den_diff_sum in den_diff_sums:
             tdds += den_diff_sum
+        group_t_den_sum = group_t_den_sum[:, t_groups]
+        group_den_sum = group_den_sum[:, t_groups]
+
+        # take minimum of target density difference sum and group density difference sum
+        group_den_sum = np.where(group_t_den_sum <= group_den_sum,
+                                 group_t_den_sum, group_den_sum)
+        # scale back group feature density different sums
+        group_den_scaled = (group_den_sum * t_n) / group_N
+        # add each marginal's scaled density differences to other marginals aggregate
+        group_tdds = np.zeros(len(t_groups))
+        for marg_den_scaled in group_den_scaled:
+            group_tdds = group_tdds + marg_den_scaled
 
         # find average of overall score and each group feature score
-        mean_tdds = tdds/len(self.marginals)
-        mean_group_tdds = group_tdds / len(self.marginals)
+        mean_tdds = tdds/n_marg
+        mean_group_tdds = group_tdds / n_marg
 
         # convert to NIST 0 - 1000 score range
-        self.scores = (1 - mean_group_tdds) * 1000
-        self.score = (2 - mean_tdds) * 500
+        scores = pd.Series((1 - mean_group_tdds) * 1000,
+                           index=pd.Index(self.uniques[group_feature][t_groups],
+                                          name=group_feature))
+        score = (2 - mean_tdds) * 500
+
+        return score, scores
+
 
+class MultiGroupKMarginal(KMarginal):
+    """
+    Grouped K-Marginal scores of several group features in one pass over the
+    marginal pairs. Each group feature keeps the marginal pairs KMarginal
+    would score it with, but each pair is counted once, jointly with all the
+    group features that use it, and the marginal of each group feature is
+    summed from the joint counts. Counting grows with the number of distinct
+    pairs rather than with pairs times group features.
+
+    After compute_score, score and scores hold the KMarginal score and group
+    scores of each group feature, keyed by group feature.
+
+    group_marginals, if given, are the marginal pairs of some of the group
+    features, instead of the pairs KMarginal would score them with.
+    """
+    def __init__(self,
+                 target_data: pd.DataFrame,
+                 deidentified_data: pd.DataFrame,
+                 group_features: List[str],
+                 seed: int = 0,
+                 target_cache: Optional[TargetMarginalCache] = None,
+                 n_jobs: int = 1,
+                 group_marginals: Optional[Dict[str, List[Tuple[str, ...]]]] = None):
+        super().__init__(target_data, deidentified_data, None,
+                         seed, target_cache, n_jobs)
+        self.group_features = group_features
+        # distinct marginal pairs of all group features, and indices of the
+        # pairs of each group feature
+        pair_index: Dict[Tuple[str, ...], int] = dict()
+        self.group_pairs: Dict[str, List[int]] = dict()
+        for g in group_features:
+            if group_marginals and g in group_marginals:
+                g_pairs = group_marginals[g]
+            else:
+                marg_cols = sorted(set(self.features).difference({g}))
+                g_pairs = get_marginal_pairs(marg_cols, self.N_PERMUTATIONS, seed)
+            self.group_pairs[g] = [pair_index.setdefault(tuple(p), len(pair_index))
+                                   for p in g_pairs]
+        self.marginals = list(pair_index.keys())
+        self.score: Dict[str, float] = dict()
+        self.scores: Dict[str, pd.Series] = dict()
+
+    def compute_score(self):
+        self._encode()
+        t_n, s_n = self.td.shape[0], self.deid.shape[0]
+        pairs = dict(enumerate(self.marginals))
+        n_jobs = min(self.n_jobs, len(pairs))
+        if n_jobs <= 1:
+            results = [multi_group_tv_sums(self.marginal_counts, pairs,
+                                           self.group_pairs, self.cards, t_n, s_n)]
+        else:
+            chunks = np.array_split(np.arange(len(pairs)), n_jobs)
+            results = self.map_shared_codes(multi_group_tv_sums,
+                                            [({i: pairs[i] for i in c},
+                                              self.group_pairs, self.cards, t_n, s_n)
+                                             for c in chunks])
+
+        for g, g_pairs in self.group_pairs.items():
+            # reduce chunk results in the marginal order of the group feature.
+            # Each chunk lists the pairs of the group feature it counted in that
+            # order, duplicates included, so each pair takes the next result of
+            # the chunk that counted it.
+            chunk_of = {i: c for c, r in enumerate(results) for i in r[g][0]}
+            next_rows = [itertools.count() for _ in results]
+            rows = [(chunk_of[i], next(next_rows[chunk_of[i]])) for i in g_pairs]
+            self.score[g], self.scores[g] = self.grouped_scores(
+                g,
+                [results[c][g][1][j] for c, j in rows],
+                np.stack([results[c][g][2][j] for c, j in rows]),
+                np.stack([results[c][g][3][j] for c, j in rows]))
         return self.score
 
+
+class SubsampleKMarginal(KMarginal):
+    """
+    K-Marginal scores of several subsamples of the target data against the
+    target data itself. Each subsample is given as target row positions, so
+    it is never materialized as a data frame nor encoded again, and the
+    marginal counts of all the subsamples are computed in one pass over the
+    target marginal keys.
+
+    After compute_score, score holds the score of each subsample and, with
+    a group feature, scores holds one column of group scores per subsample.
+    """
+    def __init__(self,
+                 target_data: pd.DataFrame,
+                 subsamples: List[np.ndarray],
+                 group_feature: Optional[str] = None,
+                 seed: int = 0,
+                 target_cache: Optional[TargetMarginalCache] = None,
+                 k: int = 2,
+                 marginals: Optional[List[Tuple[str, ...]]] = None):
+        super().__init__(target_data, target_data, group_feature,
+                         seed, target_cache, k=k, marginals=marginals)
+        self.subsamples = subsamples
+        # subsample label of each subsampled row position
+        self.rows = np.concatenate(subsamples)
+        self.row_labels = np.repeat(np.arange(len(subsamples)),
+                                    [len(s) for s in subsamples])
+
+    def compute_score(self):
+        self._encode()
+        n_sub = len(self.subsamples)
+        t_n = self.td.shape[0]
+        s_n = np.array([len(s) for s in self.subsamples])[:, None]
+        gf = self.group_features
+        if len(gf):
+            n_groups = self.cards[gf[0]]
+            t_group_codes = self.t_codes[gf[0]]
+            group_N = np.bincount(t_group_codes[t_group_codes >= 0],
+                                  minlength=n_groups)
+            group_tdds = np.zeros((n_sub, n_groups))
+
+        tdds = np.zeros(n_sub)
+        for marg in self.marginal_pairs():
+            marg = gf + marg
+            cells, t_cnt, s_cnt = self.marginal_counts(marg)
+            # t_den: target data marginal densities
+            t_den = t_cnt / t_n
+            # abs_den_diff: target and subsample densities absolute differences
+            abs_den_diff = np.abs(t_den - s_cnt / s_n)
+            tdds += abs_den_diff.sum(axis=1)
+
+            if len(gf):
+                cell_groups = cells // int(np.prod([self.cards[f] for f in marg[1:]]))
+                group_t_den_sum = group_sum(t_den, cell_groups, n_groups)
+                group_den_sum = group_sum(
+                    abs_den_diff.ravel(),
+                    (np.arange(n_sub)[:, None] * n_groups + cell_groups).ravel(),
+                    n_sub * n_groups).reshape(n_sub, n_groups)
+                group_den_sum = np.where(group_t_den_sum <= group_den_sum,
+                                         group_t_den_sum, group_den_sum)
+                group_tdds = group_tdds + (group_den_sum * t_n) / group_N
+
+        self.score = (2 - tdds / len(self.marginals)) * 500
+        if len(gf):
+            self.scores = pd.DataFrame(
+                ((1 - group_tdds / len(self.marginals)) * 1000).T,
+                index=pd.Index(self.uniques[gf[0]], name=gf[0]))
+        return self.score
+
+    def _encode(self):
+        # subsample values are target values, so the target encoding is shared
+        features = self.marginal_features()
+        self.t_fingerprint = self.target_cache.fingerprint(self.td)
+        self.t_codes, self.uniques = {}, {}
+        for f in features:
+            self.t_codes[f], self.uniques[f] = \
+                self.target_cache.encoding(self.t_fingerprint, self.td, f)
+        self.cards = {f: len(u) for f, u in self.uniques.items()}
+
+    def marginal_counts(self, marginal: List[str]):
+        """
+        Target record counts of each target cell of the marginal, and the
+        record counts of each subsample in the same cells, one row per subsample.
+        """
+        cards = [self.cards[f] for f in marginal]
+        t_cells, t_cnt = self.target_cache.counts(self.t_fingerprint,
+                                                  self.td, tuple(marginal))
+        size = int(np.prod(cards, dtype=object))
+        t_key = pack_keys([self.t_codes[f] for f in marginal], cards)
+        # position of each target record cell in t_cells
+        if size <= DENSE_MARGINAL_LIMIT and \
+                size <= max(len(t_key) * DENSE_CELLS_PER_RECORD, 1 << 16):
+            cell_pos = np.zeros(size, dtype=np.intp)
+            cell_pos[t_cells] = np.arange(len(t_cells))
+            t_cell = np.where(t_key >= 0, cell_pos[t_key], -1)
+        else:
+            t_cell = np.where(t_key >= 0, np.searchsorted(t_cells, t_key), -1)
+        # cells of subsample records, subsample cells are a subset of target cells
+        s_cell = t_cell[self.rows]
+        valid = s_cell >= 0
+        s_cell = self.row_labels[valid] * len(t_cells) + s_cell[valid]
+        s_cnt = np.bincount(s_cell, minlength=len(self.subsamples) * len(t_cells))
+        return t_cells, t_cnt, s_cnt.reshape(len(self.subsamples), len(t_cells))
+
+
+class StreamingKMarginal(KMarginal):
+    """
+    K-Marginal score of deidentified data that is read in chunks, for files
+    too large to be loaded at once. Only running counts of the cells of each
+    marginal seen in the deidentified data are kept between chunks.
+
+        k_marg = StreamingKMarginal(target_data, 'PUMA')
+        for chunk in pd.read_csv(path, chunksize=100_000):
+            k_marg.update(chunk)
+        score = k_marg.finalize()
+
+    pyarrow record batches, e.g. from ParquetFile.iter_batches, can be passed
+    to update as well. Chunks must hold the target features in the target
+    data encoding. The scores are the scores of KMarginal on the whole
+    deidentified data.
+    """
+    def __init__(self,
+                 target_data: pd.DataFrame,
+                 group_feature: Optional[str] = None,
+                 seed: int = 0,
+                 target_cache: Optional[TargetMarginalCache] = None,
+                 k: int = 2):
+        super().__init__(target_data, target_data.iloc[:0], group_feature,
+                         seed, target_cache, k=k)
+        self.t_fingerprint = self.target_cache.fingerprint(self.td)
+        self.count_marginals = [tuple(self.group_features + m)
+                                for m in self.marginal_pairs()]
+        self.count_features = sorted(set(self.group_features).union(
+            *[set(m) for m in self.marginals]))
+        # values of each feature in order of appearance, target values first
+        self.values: Dict[str, pd.Index] = {
+            f: pd.Index(self.target_cache.encoding(self.t_fingerprint, self.td, f)[1])
+            for f in self.count_features
+        }
+        self.n_t_values = {f: len(v) for f, v in self.values.items()}
+        # deidentified cells, as value codes of each marginal feature, and counts
+        self.s_counts: Dict[Tuple[str, ...], Tuple[List[np.ndarray], np.ndarray]] = {
+            m: ([np.zeros(0, dtype=np.int64) for _ in m], np.zeros(0, dtype=np.int64))
+            for m in self.count_marginals
+        }
+        self.s_n = 0
+
+    def update(self, chunk):
+        """Add the marginal counts of a chunk of deidentified records."""
+        if not isinstance(chunk, pd.DataFrame):
+            # pyarrow record batches and tables
+            chunk = chunk.to_pandas()
+        codes = dict()
+        for f in self.count_features:
+            c_codes, c_uniques = pd.factorize(chunk[f])
+            pos = self.values[f].get_indexer(c_uniques)
+            new = pos < 0
+            if new.any():
+                pos[new] = len(self.values[f]) + np.arange(new.sum())
+                self.values[f] = self.values[f].append(c_uniques[new])
+            codes[f] = np.where(c_codes >= 0, pos[c_codes], -1)
+
+        for marg in self.count_marginals:
+            cards = [len(self.values[f]) for f in marg]
+            key = pack_keys([codes[f] for f in marg], cards)
+            s_codes, s_cnt = self.s_counts[marg]
+            key = np.concatenate([pack_keys(s_codes, cards), key[key >= 0]])
+            counts = np.concatenate([s_cnt, np.ones(len(key) - len(s_cnt),
+                                                    dtype=np.int64)])
+            cells, inverse = np.unique(key, return_inverse=True)
+            counts = np.bincount(inverse, weights=counts).astype(np.int64)
+            self.s_counts[marg] = (unpack_keys(cells, cards), counts)
+        self.s_n += chunk.shape[0]
+
+    def finalize(self):
+        """Compute the score of all the chunks added with update."""
+        return self.compute_score()
+
+    def _encode(self):
+        # sort the values of each feature, as KMarginal encodes them
+        self.t_codes, self.t_remap, self.s_remap, self.uniques = {}, {}, {}, {}
+        for f in self.count_features:
+            codes, uniques = pd.factorize(pd.Series(self.values[f]), sort=True)
+            self.t_codes[f] = self.target_cache.encoding(self.t_fingerprint,
+                                                         self.td, f)[0]
+            self.t_remap[f] = codes[:self.n_t_values[f]]
+            self.s_remap[f] = codes
+            self.uniques[f] = uniques
+        self.cards = {f: len(u) for f, u in self.uniques.items()}
+
+    def marginal_counts(self, marginal: List[str]):
+        cards = [self.cards[f] for f in marginal]
+        t_cells, t_cnt = self.target_counts(marginal)
+        s_codes, s_cnt = self.s_counts[tuple(marginal)]
+        s_key = pack_keys([self.s_remap[f][c] for f, c in zip(marginal, s_codes)],
+                          cards)
+        order = np.argsort(s_key)
+        return joint_counts(t_cells, t_cnt, s_key[order], s_cnt[order])
+
+    def marginal_tv_sums(self, marginals: List[List[str]], n_groups: int = 0):
+        return marginal_tv_sums(self.marginal_counts, marginals, self.cards,
+                                self.td.shape[0], self.s_n, n_groups)
@@ -1,14 +1,71 @@
 import os
-import math
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
 from sklearn import tree
+from sklearn.ensemble import HistGradientBoostingClassifier
+from sklearn.model_selection import StratifiedKFold
 from scipy.stats import ks_2samp
 
 from sdnist.utils import *
 
+# names of the classifiers the propensities can be computed with
+TREE = 'tree'
+HIST_GRADIENT_BOOSTING = 'hist_gradient_boosting'
+
+
+def propensity_classifier(classifier: str, seed: int):
+    if classifier == TREE:
+        return tree.DecisionTreeClassifier(max_depth=6, random_state=seed)
+    elif classifier == HIST_GRADIENT_BOOSTING:
+        # fast on the integer coded features, which fit in its 255 bins
+        return HistGradientBoostingClassifier(early_stopping=False,
+                                              random_state=seed)
+    raise ValueError(f'Unknown propensity classifier: {classifier}. '
+                     f'Use one of {[TREE, HIST_GRADIENT_BOOSTING]}')
+
+
+def fold_propensities(clf, X: np.ndarray, i: np.ndarray,
+                      train: np.ndarray, test: np.ndarray) -> np.ndarray:
+    # probabilities of the test rows being synthetic, from the train rows
+    clf.fit(X[train], i[train])
+    return clf.predict_proba(X[test])[:, 1]
+
+
+def propensity_scores(X: np.ndarray, i: np.ndarray, classifier: str,
+                      n_folds: Optional[int], seed: int, n_jobs: int = 1) -> np.ndarray:
+    """
+    Probability of each row of X being synthetic. Without n_folds the
+    classifier predicts the rows it is fitted on, otherwise out-of-fold
+    probabilities are predicted, with the folds fitted in n_jobs workers.
+    """
+    if not n_folds:
+        clf = propensity_classifier(classifier, seed)
+        clf.fit(X, i)
+        return clf.predict_proba(X)[:, 1]
+
+    # out-of-fold propensities, folds are fitted in parallel and large
+    # inputs are shared with the workers through memory maps
+    folds = list(StratifiedKFold(n_folds, shuffle=True,
+                                 random_state=seed).split(X, i))
+    fold_probs = Parallel(n_jobs=n_jobs)(
+        delayed(fold_propensities)(propensity_classifier(classifier, seed),
+                                   X, i, train, test)
+        for train, test in folds)
+    syn_prob = np.empty(X.shape[0])
+    for (_, test), probs in zip(folds, fold_probs):
+        syn_prob[test] = probs
+    return syn_prob
+
+
+def subsample_pmse(X: np.ndarray, i: np.ndarray, classifier: str,
+                   n_folds: Optional[int], seed: int) -> float:
+    # pMSE of a classifier fitted on one subsample of the records
+    syn_prob = propensity_scores(X, i, classifier, n_folds, seed)
+    return float(np.mean((syn_prob - i.mean()) ** 2))
+
 
 class PropensityMSE:
     NAME = 'Propensity Mean Square Error'
@@ -18,11 +75,59 @@ class PropensityMSE:
                  target: pd.DataFrame,
                  synthetic: pd.DataFrame,
                  output_directory: Path,
-                 features: Optional[List[str]] = None):
+                 features: Optional[List[str]] = None,
+                 classifier: str = TREE,
+                 n_folds: Optional[int] = None,
+                 n_jobs: int = 1,
+                 seed: int = 0,
+                 max_rows: Optional[int] = None,
+                 n_subsamples: int = 10):
+        """
+        Parameters
+        ----------
+            target : pd.Dataframe
+                target dataset
+            synthetic : pd.Dataframe
+                deidentified dataset
+            output_directory: Path
+                path of the directory to which results will be saved
+            features: List[str]
+                features the classifier is fitted on, all the target features by default
+            classifier: str
+                'tree' for a depth 6 decision tree or 'hist_gradient_boosting'
+            n_folds: Optional[int]
+                if given, propensities of each fold of records are predicted by a
+                classifier fitted on the other folds. Otherwise the classifier
+                predicts the records it is fitted on.
+            n_jobs: int
+                number of folds, or of subsamples, fitted in parallel, -1 uses
+                all the cpus
+            seed: int
+                seed of the folds, of the classifier and of the subsample of
+                records
+            max_rows: Optional[int]
+                if the target and synthetic data have more records, the
+                classifier is fitted and scored on a seeded subsample of the same
+                fraction of each
+            n_subsamples: int
+                number of other seeded subsamples a classifier is refitted on
+                when the records are subsampled. The spread of their pMSEs is
+                reported with the score.
+        """
+        propensity_classifier(classifier, seed)  # validate the classifier name
+        self.classifier = classifier
+        self.n_folds = n_folds
+        self.n_jobs = n_jobs
+        self.seed = seed
+        self.max_rows = max_rows
+        self.n_subsamples = n_subsamples
         self.features = features if features \
             else target.columns.tolist()
-        self.target = target[self.features]
-        self.synthetic = synthetic[self.features]
+        # frames are only copied when their columns differ from the features
+        self.target = target if target.columns.tolist() == self.features \
+            else target[self.features]
+        self.synthetic = synthetic if synthetic.columns.tolist() == self.features \
+            else synthetic[self.features]
         self.o_dir = output_directory
         self.o_path = Path(self.o_dir, 'propensity')
         # probability of classifying a sample as belong
@@ -31,6 +136,11 @@ class PropensityMSE:
         self.pmse_score: float = 0  # propensity mean square error score
         self.ks_score: float = 0  # kolmogorov-smirnov test score
         self.prob_dist = pd.DataFrame()  # sample distribution over propensity bins
+        self.sampling_fraction: float = 1  # fraction of the records fitted and scored
+        # pMSEs of the classifiers refitted on other subsamples and their
+        # spread, only when the records are subsampled
+        self.subsample_pmses: List[float] = []
+        self.pmse_spread: Optional[float] = None
         self.report_data = dict()
 
         self._setup()
@@ -43,58 +153,110 @@ class PropensityMSE:
 
     def compute_score(self):
         t, s = self.target, self.synthetic
+        if self.max_rows:
+            t, s = self.subsample(t, s)
 
         # compute for all features
         score = self.pmse(t, s)
         self.score = score
         return self.score
 
+    def subsample(self, t: pd.DataFrame, s: pd.DataFrame,
+                  seed: Optional[int] = None):
+        """
+        Subsample of the target and synthetic records with at most max_rows
+        records, drawn with seed or the seed of the metric. Both datasets are
+        sampled with the same fraction so the share of synthetic records, the
+        pMSE baseline, is preserved.
+        """
+        self.sampling_fraction = min(1, self.max_rows / (self.target.shape[0]
+                                                         + self.synthetic.shape[0]))
+        if self.sampling_fraction == 1:
+            return t, s
+        rng = np.random.default_rng(self.seed if seed is None else seed)
+        t_rows = rng.choice(t.shape[0], size=int(t.shape[0] * self.sampling_fraction),
+                            replace=False)
+        s_rows = rng.choice(s.shape[0], size=int(s.shape[0] * self.sampling_fraction),
+                            replace=False)
+        return t.iloc[np.sort(t_rows)], s.iloc[np.sort(s_rows)]
+
+    def subsample_spread(self) -> float:
+        """
+        1.96 standard deviations of the pMSEs of classifiers refitted on
+        n_subsamples other seeded subsamples of the records, fitted in parallel.
+        This is the variation of the score from subsampling and refitting.
+        """
+        seeds = [self.seed + b + 1 for b in range(self.n_subsamples)]
+        self.subsample_pmses = Parallel(n_jobs=self.n_jobs)(
+            delayed(subsample_pmse)(*self.training_data(*self.subsample(self.target,
+                                                                        self.synthetic,
+                                                                        seed)),
+                                    self.classifier, self.n_folds, seed)
+            for seed in seeds)
+        return float(1.96 * np.std(self.subsample_pmses, ddof=1))
+
+    def propensity_distribution(self, syn_prob: np.ndarray,
+                                indicator: np.ndarray) -> pd.DataFrame:
+        """
+        Number of target and synthetic samples in each of the propensity bins.
+        Probabilities are rounded to 2 decimals before binning, and a probability
+        of 1 falls in the last bin.
+        """
+        bin_idx = np.floor(np.round(syn_prob, 2) * self.bins).astype(np.int64)
+        bin_idx[bin_idx == self.bins] = self.bins - 1
+        synthetic = indicator == 1
+        return pd.DataFrame({'Target samples': np.bincount(bin_idx[~synthetic],
+                                                           minlength=self.bins),
+                             'Deid. samples': np.bincount(bin_idx[synthetic],
+                                                          minlength=self.bins)},
+                            index=range(self.bins))
+
+    def training_data(self, t: pd.DataFrame, s: pd.DataFrame) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Classifier input of target rows followed by synthetic rows, and an
+        indicator of the synthetic rows (target rows marked with 0 and
+        synthetic rows with 1). The input is float32, the dtype sklearn trees
+        fit on, so it is assembled once without intermediate frames.
+        """
+        X = np.empty((t.shape[0] + s.shape[0], t.shape[1]), dtype=np.float32)
+        for j, f in enumerate(t.columns):
+            X[:t.shape[0], j] = t[f].values
+            X[t.shape[0]:, j] = s[f].values
+        i = np.repeat(np.array([0, 1], dtype=np.int8), [t.shape[0], s.shape[0]])
+        return X, i
+
+    def propensities(self, X: np.ndarray, i: np.ndarray) -> np.ndarray:
+        return propensity_scores(X, i, self.classifier, self.n_folds,
+                                 self.seed, self.n_jobs)
+
     def pmse(self, t: pd.DataFrame, s: pd.DataFrame):
-        t, s = t.copy(), s.copy()
-        f = t.columns.tolist()
-        # 'i' is an indicator column to indicate either a row
-        # is sample from target data (marked with 0) or synthetic data
-        # with indicator value of 1.
-        t['i'], s['i'] = [0] * t.shape[0], [1] * s.shape[0]
-
-        # Concatenate target and synthetic dataset rows to
-        # form one single training dataset
-        N = pd.concat([t, s]).reset_index(drop=True)
-
-        clf = tree.DecisionTreeClassifier(max_depth=6)
-        clf.fit(N[f].values, N['i'].values)
-
-        pprob = clf.predict_proba(N[f].values)  # prediction probabilities
-        syn_prob = np.transpose(pprob)[1]  # probability of being a synthetic sample
-
-        oc = [[0, 0] for _ in range(self.bins)]
-        sc = [[0, 0] for _ in range(self.bins)]
-
-        for ir, r in N.iterrows():
-            p = round(syn_prob[ir], 2)
-            pi = math.floor(p * self.bins)
-            pi = pi - 1 if pi == self.bins else pi
-            # print(pi)
-            if N.iloc[ir]['i'] == 0:
-                oc[pi][0] += 1
-            else:
-                sc[pi][0] += 1
-        self.prob_dist = pd.DataFrame([[o[0], s[0]]
-                                      for o, s in zip(oc, sc)],
-                                      columns=['Target samples', 'Deid. samples'],
-                                      index=range(self.bins))
-
-        N_size = N.shape[0]
+        X, i = self.training_data(t, s)
+
+        syn_prob = self.propensities(X, i)  # probability of being a synthetic sample
+
+        self.prob_dist = self.propensity_distribution(syn_prob, i)
+
+        N_size = X.shape[0]
         s_size = s.shape[0]  # size of synthetic data
 
         c = s_size / N_size
 
-        self.pmse_score = 1 / N_size * sum([(_pi - c) ** 2
-                                            for _pi in syn_prob])
+        sq_err = (syn_prob - c) ** 2
+        self.pmse_score = float(np.mean(sq_err))
         orig_syn_prob = syn_prob[:t.shape[0]]
         syn_syn_prob = syn_prob[t.shape[0]:]
         self.ks_score = ks_2samp(orig_syn_prob, syn_syn_prob)
         self.report_data["pmse_score"] = self.pmse_score
+        self.report_data["classifier"] = self.classifier
+        if self.n_folds:
+            self.report_data["n_folds"] = self.n_folds
+        if self.max_rows:
+            self.report_data["sampling_fraction"] = self.sampling_fraction
+        if self.sampling_fraction < 1 and self.n_subsamples > 1:
+            self.pmse_spread = self.subsample_spread()
+            self.report_data["subsample_pmses"] = self.subsample_pmses
+            self.report_data["pmse_spread"] = self.pmse_spread
         self.report_data["propensity_distribution"] = relative_path(save_data_frame(self.prob_dist,
                                                                                     self.o_path,
                                                                                     'dist'))
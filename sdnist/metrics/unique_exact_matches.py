@@ -1,34 +1,119 @@
-import pandas as pd
-from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
-from sdnist.load import TestDatasetName
+import numpy as np
+import pandas as pd
 
-from sdnist.report.dataset import Dataset
-import sdnist.utils as u
+# multiplier combining the column hashes of a row fingerprint
+FNV_PRIME = np.uint64(0x100000001B3)
+
+
+def common_dtypes(dfs: List[pd.DataFrame], cols: List[str]) -> Dict[str, np.dtype]:
+    """
+    Dtype of each column in which values of all the dataframes are compared,
+    so that values equal in a merge on the columns have equal hashes.
+    """
+    dtypes = {}
+    for c in cols:
+        c_dtypes = [df[c].dtype for df in dfs]
+        if all(isinstance(d, np.dtype) and d.kind in 'biuf' for d in c_dtypes):
+            dtypes[c] = c_dtypes[0] if len(set(c_dtypes)) == 1 \
+                else np.result_type(*c_dtypes, np.float64)
+        else:
+            dtypes[c] = np.dtype(object)
+    return dtypes
+
+
+def column_values(df: pd.DataFrame, col: str, dtype: np.dtype,
+                  rows: Optional[np.ndarray] = None) -> np.ndarray:
+    values = df[col].to_numpy()
+    if rows is not None:
+        values = values[rows]
+    values = values.astype(dtype, copy=False)
+    if values.dtype.kind == 'f':
+        # one bit pattern for zero and for missing values
+        values = np.where(np.isnan(values), np.nan, values + 0.0)
+    return values
+
+
+def row_fingerprints(df: pd.DataFrame, dtypes: Dict[str, np.dtype]) -> np.ndarray:
+    """64-bit hash of the values of each row."""
+    fp = np.zeros(df.shape[0], dtype=np.uint64)
+    for c, dtype in dtypes.items():
+        fp = (fp * FNV_PRIME) ^ pd.util.hash_array(column_values(df, c, dtype))
+    return fp
+
+
+def equal_rows(dfs: List[pd.DataFrame], dtypes: Dict[str, np.dtype],
+               first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """
+    True for each row at positions first that is equal to the row at the same
+    index of positions second, positions of the records of all the dataframes
+    one after the other. Missing values are equal to each other, as in a merge.
+    """
+    offsets = np.cumsum([0] + [df.shape[0] for df in dfs])
+
+    def take(col: str, dtype: np.dtype, pos: np.ndarray) -> np.ndarray:
+        values = np.empty(len(pos), dtype=dtype)
+        frame = np.searchsorted(offsets, pos, side='right') - 1
+        for i, df in enumerate(dfs):
+            in_df = frame == i
+            values[in_df] = column_values(df, col, dtype, pos[in_df] - offsets[i])
+        return values
+
+    equal = np.ones(len(first), dtype=bool)
+    for c, dtype in dtypes.items():
+        x, y = take(c, dtype, first), take(c, dtype, second)
+        diff = np.flatnonzero(x != y)
+        if len(diff):
+            equal[diff[~(pd.isna(x[diff]) & pd.isna(y[diff]))]] = False
+    return equal
+
+
+def row_keys(dfs: List[pd.DataFrame], cols: List[str]) -> np.ndarray:
+    """
+    Row keys of several dataframes, records of all the dataframes one after
+    the other, equal for equal rows. Keys are the row fingerprints when rows
+    with equal fingerprints are verified to be equal, else the rows are keyed
+    exactly from the codes of their values.
+    """
+    dtypes = common_dtypes(dfs, cols)
+    fp = np.concatenate([row_fingerprints(df, dtypes) for df in dfs])
+    order = np.argsort(fp)
+    same_fp = np.flatnonzero(fp[order[1:]] == fp[order[:-1]])
+    if equal_rows(dfs, dtypes, order[same_fp], order[same_fp + 1]).all():
+        return fp
+    # hash collision
+    return exact_row_keys(dfs, cols)
+
+
+def exact_row_keys(dfs: List[pd.DataFrame], cols: List[str]) -> np.ndarray:
+    codes = [pd.factorize(pd.concat([df[c] for df in dfs], ignore_index=True))[0]
+             for c in cols]
+    return pd.MultiIndex.from_arrays(codes).factorize()[0]
 
 
 def unique_exact_matches(target_data: pd.DataFrame, deidentified_data: pd.DataFrame):
     td, dd = target_data, deidentified_data
     cols = td.columns.tolist()
 
-    # select rows that are unique in the target data
-    # Step 1: Mark all duplicates (considering all columns by default)
-    duplicates = td.duplicated(keep=False)
+    # one key per row, shared by target and deidentified data
+    keys = row_keys([td, dd], cols)
+    t_keys, d_keys = keys[:td.shape[0]], keys[td.shape[0]:]
 
-    # Step 2: Filter the DataFrame to keep only unique rows
-    u_td = td[~duplicates]
+    # select rows that are unique in the target data
+    t_values, t_counts = np.unique(t_keys, return_counts=True)
+    u_t_keys = t_values[t_counts == 1]
 
-    # target unique records
-    t_unique_records = u_td.shape[0]
-    perc_t_unique_records = round(t_unique_records/td.shape[0] * 100, 2)
+    # number of unique target records that exactly match in deidentified data,
+    # each one counted once however many times it is in the deidentified data
+    t_rec_matched = len(np.intersect1d(u_t_keys, np.unique(d_keys), assume_unique=True))
 
-    # Keep only one copy of each duplicate row in the deidentified data
-    dd = dd.drop_duplicates(subset=cols)
+    return match_percentages(t_rec_matched, len(u_t_keys), td.shape[0])
 
-    merged = u_td.merge(dd, how='inner', on=cols)
 
-    # number of unique target records that exactly match in deidentified data
-    t_rec_matched = merged.shape[0]
+def match_percentages(t_rec_matched: int, t_unique_records: int, t_records: int):
+    # target unique records
+    perc_t_unique_records = round(t_unique_records/t_records * 100, 2)
 
     if t_unique_records > 0:
         # percent of unique target records that exactly match in deidentified data
@@ -41,7 +126,84 @@ def unique_exact_matches(target_data: pd.DataFrame, deidentified_data: pd.DataFr
     return t_rec_matched, perc_t_rec_matched, t_unique_records, perc_t_unique_records
 
 
+class StreamingUniqueExactMatches:
+    """
+    Unique exact matches of deidentified data that is read in chunks, for
+    files too large to be loaded at once. The fingerprints of the unique
+    target rows are computed once, and a bitmap of the unique target rows
+    matched by any chunk is kept between chunks.
+
+        uem = StreamingUniqueExactMatches(target_data)
+        for chunk in pd.read_csv(path, chunksize=100_000):
+            uem.update(chunk)
+        results = uem.finalize()
+
+    pyarrow record batches, e.g. from ParquetFile.iter_batches, can be passed
+    to update as well. Chunks must hold the target features in the target
+    data encoding. Results are those of unique_exact_matches on the whole
+    deidentified data. The report loads the whole deidentified data in its
+    Dataset and scores it with unique_exact_matches; this class is for
+    deidentified files scored outside of the report.
+    """
+    def __init__(self, target_data: pd.DataFrame):
+        self.td = target_data
+        self.cols = target_data.columns.tolist()
+        # positions of the rows that are unique in the target data
+        _, inverse, counts = np.unique(row_keys([self.td], self.cols),
+                                       return_inverse=True, return_counts=True)
+        self.unique_rows = np.flatnonzero(counts[inverse] == 1)
+        # bitmap of the unique target rows that exactly match deidentified rows
+        self.matched = np.zeros(len(self.unique_rows), dtype=bool)
+        # sorted fingerprints of the unique target rows and their order, by the
+        # dtypes the target and a chunk are compared in
+        self._fingerprints: Dict[tuple, Tuple[np.ndarray, np.ndarray]] = {}
+
+    def target_fingerprints(self, dtypes: Dict[str, np.dtype]) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        key = tuple(dtypes.values())
+        if key not in self._fingerprints:
+            fp = row_fingerprints(self.td, dtypes)[self.unique_rows]
+            order = np.argsort(fp)
+            self._fingerprints[key] = fp[order], order
+        return self._fingerprints[key]
+
+    def update(self, chunk):
+        """Mark the unique target rows exactly matched by a chunk of deidentified records."""
+        if not isinstance(chunk, pd.DataFrame):
+            # pyarrow record batches and tables
+            chunk = chunk.to_pandas()
+        dtypes = common_dtypes([self.td, chunk], self.cols)
+        t_fp, t_order = self.target_fingerprints(dtypes)
+        c_fp = row_fingerprints(chunk, dtypes)
+
+        # pairs of unique target rows and chunk rows with equal fingerprints
+        start = np.searchsorted(t_fp, c_fp, side='left')
+        n_pairs = np.searchsorted(t_fp, c_fp, side='right') - start
+        c_rows = np.repeat(np.arange(chunk.shape[0]), n_pairs)
+        offsets = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+        u_rows = t_order[np.repeat(start, n_pairs) + offsets]
+
+        # pairs of equal rows, fingerprint collisions are not matches
+        equal = equal_rows([self.td, chunk], dtypes,
+                           self.unique_rows[u_rows], self.td.shape[0] + c_rows)
+        self.matched[u_rows[equal]] = True
+
+    def finalize(self):
+        """
+        :return: number and percent of the unique target records that exactly
+            match deidentified records, number and percent of unique target records
+        """
+        return match_percentages(int(self.matched.sum()), len(self.unique_rows),
+                                 self.td.shape[0])
+
+
 if __name__ == '__main__':
+    from pathlib import Path
+
+    from sdnist.load import TestDatasetName
+    from sdnist.report.dataset import Dataset
+    import sdnist.utils as u
+
     THIS_DIR = Path(__file__).parent
     s_path = Path(THIS_DIR, '..', '..',
                   'toy_synthetic_data/syn/sdcmicro/k_ano_k_6.csv')
@@ -14,6 +14,7 @@ from sdnist.strs import *
 from sdnist.utils import *
 
 from sdnist.load import DEFAULT_DATASET
+from sdnist.metrics.dcr import DCR_SAMPLE_ROWS
 
 
 def run(synthetic_filepath: Path,
@@ -22,7 +23,11 @@ def run(synthetic_filepath: Path,
         data_root: Path = Path(DEFAULT_DATASET),
         labels_dict: Optional[Dict] = None,
         download: bool = False,
-        show_report: bool = True):
+        show_report: bool = True,
+        n_jobs: int = 1,
+        baseline_dir: Optional[Path] = None,
+        propensity_max_rows: Optional[int] = None,
+        dcr_max_rows: Optional[int] = DCR_SAMPLE_ROWS):
     try:
         outfile = Path(output_directory, 'report.json')
         ui_data = ReportUIData(output_directory=output_directory)
@@ -40,11 +45,14 @@ def run(synthetic_filepath: Path,
 
             # Create scores
             log.msg('Computing Utility Scores', level=2)
-            ui_data, report_data = utility_score(dataset, ui_data, report_data, log)
+            ui_data, report_data = utility_score(dataset, ui_data, report_data, log,
+                                                 n_jobs, baseline_dir,
+                                                 propensity_max_rows)
             log.end_msg()
 
             log.msg('Computing Privacy Scores', level=2)
-            ui_data, report_data = privacy_score(dataset, ui_data, report_data, log)
+            ui_data, report_data = privacy_score(dataset, ui_data, report_data, log,
+                                                 n_jobs, dcr_max_rows)
             log.end_msg()
 
             log.msg('Saving Report Data')
@@ -93,6 +101,35 @@ def setup():
                         default=Path(DEFAULT_DATASET),
                         help="Path of the directory "
                              "to be used as the root for the target datasets.")
+    parser.add_argument("--n-jobs", type=int,
+                        default=1,
+                        help="Number of parallel workers used to compute the "
+                             "k-marginal and k-DiSCO scores (processes), the "
+                             "distance to closest record (threads) and the "
+                             "cross-validated propensity folds. -1 uses all "
+                             "the cpus.")
+    parser.add_argument("--propensity-max-rows", type=int,
+                        default=None,
+                        help="Maximum number of target and deidentified "
+                             "records the propensity classifier is fitted on. "
+                             "Larger datasets are sampled, and the spread of "
+                             "the score over classifiers refitted on other "
+                             "samples is reported. All the records are used "
+                             "if not given.")
+    parser.add_argument("--baseline-dir", type=Path,
+                        default=None,
+                        help="Directory in which the k-marginal sub-sample "
+                             "baselines of the target dataset are saved, and "
+                             "reused by later reports on the same target. "
+                             "Baselines are recomputed by each report if not "
+                             "given.")
+    parser.add_argument("--dcr-max-rows", type=int,
+                        default=DCR_SAMPLE_ROWS,
+                        help="Maximum number of deidentified records, and of "
+                             "held out target records, whose distance to "
+                             "closest record is computed. Larger datasets are "
+                             "sampled. 0 computes the distances of all the "
+                             "records.")
 
     group = parser.add_argument_group(title='Choices for Target Dataset Name')
     group.add_argument('[DATASET NAME]', help='[FILENAME]', action='none')
@@ -137,6 +174,10 @@ def setup():
         OUTPUT_DIRECTORY: this_report_dir,
         LABELS_DICT: labels,
         DOWNLOAD: True,
+        N_JOBS: args.n_jobs,
+        PROPENSITY_MAX_ROWS: args.propensity_max_rows,
+        BASELINE_DIR: args.baseline_dir,
+        DCR_MAX_ROWS: args.dcr_max_rows or None,
     }
     return input_cnf
 
@@ -1,11 +1,12 @@
-from typing import List
+from typing import List, Union
 import matplotlib.pyplot as plt
 
-from sdnist.metrics.apparent_match_dist import cellchange
+from sdnist.metrics.apparent_match_dist import quasi_set_matches, matched_records
 from sdnist.utils import *
 
 def plot_apparent_match_dist(match_percentages: pd.Series,
-                             output_directory: Path) -> Path:
+                             output_directory: Path,
+                             name: str = 'dist') -> Path:
     fig = plt.figure(figsize=(6, 6), dpi=100)
 
     if len(match_percentages):
@@ -23,7 +24,7 @@ def plot_apparent_match_dist(match_percentages: pd.Series,
     plt.yticks(fontsize=10)
     plt.title(
         'Percentage of Matched Records', fontsize=12)
-    out_file = Path(output_directory, f'dist.jpg')
+    out_file = Path(output_directory, f'{name}.jpg')
     x1, x2, y1, y2 = plt.axis()
     plt.axis((x1 - 2, x2 + 2, y1, y2 + 0.05))
     fig.tight_layout()
@@ -37,7 +38,7 @@ class ApparentMatchDistributionPlot:
                  synthetic: pd.DataFrame,
                  target: pd.DataFrame,
                  output_directory: Path,
-                 quasi_features: List[str],
+                 quasi_features: Union[List[str], List[List[str]]],
                  exclude_features: List[str]):
         """
         Computes and plots apparent records match distribution between
@@ -51,8 +52,10 @@ class ApparentMatchDistributionPlot:
                 target dataset
             output_directory: pd.Dataframe
                 path of the directory to which plots will will be saved
-            quasi_features: List[str]
-                Subset of features for which to find apparent record matches
+            quasi_features: List[str] | List[List[str]]
+                Subset of features for which to find apparent record matches,
+                or several subsets, e.g. of several adversary models. One
+                distribution is computed and plotted for each subset.
             exclude_features:
                 features to exclude from matching between dataset
         """
@@ -60,9 +63,14 @@ class ApparentMatchDistributionPlot:
         self.tar = target
         self.o_dir = output_directory
         self.o_path = Path(self.o_dir, 'apparent_match_dist')
-        self.quasi_features = quasi_features
+        if all(isinstance(f, str) for f in quasi_features):
+            quasi_features = [quasi_features]
+        self.quasi_feature_sets = [list(q) for q in quasi_features]
+        self.quasi_features = self.quasi_feature_sets[0]
         self.exclude_features = exclude_features
         self.quasi_matched_df = pd.DataFrame()
+        # matched records of each quasi-identifier set
+        self.quasi_matched_dfs: List[pd.DataFrame] = []
         self.report_data = dict()
         self._setup()
 
@@ -73,16 +81,34 @@ class ApparentMatchDistributionPlot:
         os.mkdir(self.o_path)
 
     def save(self) -> List[Path]:
-        percents, u1, u2, mu = cellchange(self.syn, self.tar,
-                                          self.quasi_features,
-                                          self.exclude_features)
-        self.quasi_matched_df = mu
+        matches = quasi_set_matches(self.syn, self.tar,
+                                    self.quasi_feature_sets,
+                                    self.exclude_features)
+        save_file_paths = []
+        set_report_data = []
+        for i, (quasi, (percents, rows1, rows2)) in \
+                enumerate(zip(self.quasi_feature_sets, matches)):
+            suffix = f'_{i}' if i else ''
+            mu = matched_records(self.syn, self.tar, quasi, rows1, rows2)
+            self.quasi_matched_dfs.append(mu)
 
-        save_file_path = plot_apparent_match_dist(percents,
-                                                  self.o_path)
-        mu['percent_match'] = percents
+            save_file_path = plot_apparent_match_dist(percents,
+                                                      self.o_path,
+                                                      f'dist{suffix}')
+            mu['percent_match'] = percents
+            save_file_paths.append(save_file_path)
+            set_report_data.append({
+                'quasi_identifiers': quasi,
+                'unique_matched_percents':
+                    relative_path(save_data_frame(mu, self.o_path, f'result{suffix}')),
+                'plot': relative_path(save_file_path)
+            })
+
+        self.quasi_matched_df = self.quasi_matched_dfs[0]
         self.report_data['unique_matched_percents'] = \
-            relative_path(save_data_frame(mu, self.o_path, 'result'))
-        self.report_data['plot'] = relative_path(save_file_path)
+            set_report_data[0]['unique_matched_percents']
+        self.report_data['plot'] = set_report_data[0]['plot']
+        if len(set_report_data) > 1:
+            self.report_data['quasi_identifier_sets'] = set_report_data
 
-        return [save_file_path]
+        return save_file_paths
@@ -105,6 +105,16 @@ unique_exact_match_para_1 = (
     "Unique Exact Match (UEM) is a simple privacy metric that counts the percentage of singleton records in the target data that are also present in the deidentified data; these uniquely identifiable individuals leaked through the deidentification process."
 )
 
+dcr_para = (
+    "Distance to Closest Record (DCR) measures how far each deidentified record is from its "
+    "closest record in the target data, as the share of features on which the two records differ "
+    "(numeric features contribute their difference scaled by the feature range). "
+    "As a baseline, the target data is split in half: a held out half and a reference half. "
+    "The distances of held out records to their closest reference record show how close real "
+    "individuals are to each other. Deidentified records that are systematically closer to the "
+    "reference records than held out records are may be copies or near copies of real individuals."
+)
+
 # Explainer paragraphs for DiSCO Metric
 disco_explainer_a = (
     "The <a href='https://arxiv.org/abs/2406.16826'>Disclosive in Synthetic Correct Original"
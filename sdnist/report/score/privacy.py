@@ -1,7 +1,8 @@
-from typing import Tuple
+from typing import Optional, Tuple
 
 from sdnist.report import Dataset, ReportData, ReportUIData
 from sdnist.report.plots import ApparentMatchDistributionPlot
+from sdnist.metrics.dcr import DCR_SAMPLE_ROWS, DistanceToClosestRecord
 from sdnist.metrics.disco import KDiscoEvaluator
 from sdnist.metrics.unique_exact_matches import unique_exact_matches
 from sdnist.report.report_data import PrivacyScorePacket, Attachment, AttachmentType
@@ -12,7 +13,8 @@ from sdnist.load import TestDatasetName
 
 
 def privacy_score(
-    dataset: Dataset, ui_data: ReportUIData, report_data, log: SimpleLogger
+    dataset: Dataset, ui_data: ReportUIData, report_data, log: SimpleLogger,
+    n_jobs: int = 1, dcr_max_rows: Optional[int] = DCR_SAMPLE_ROWS
 ) -> Tuple[ReportUIData, ReportData]:
     ds: Dataset = dataset
     r_ui_d: ReportUIData = ui_data
@@ -79,6 +81,11 @@ def privacy_score(
         quasi_idf = ["SEX", "MSP", "RAC1P", "OWN_RENT", "EDU", "PUMA",
                      "INDP_CAT", "HISP"]
     quasi_idf = list(set(ds.features).intersection(set(quasi_idf)))
+    # apparent matches are also computed for the quasi-identifiers of
+    # other adversary models: an adversary that does not know the PUMA
+    quasi_idf_sets = [quasi_idf]
+    if "PUMA" in quasi_idf and len(quasi_idf) > 1:
+        quasi_idf_sets.append([f for f in quasi_idf if f != "PUMA"])
     if len(quasi_idf) == 0:
         log.msg(
             "No quasi-identifier feature found in the dataset. Skipping Apparent Match Distribution.",
@@ -108,7 +115,7 @@ def privacy_score(
             ds.c_synthetic_data,
             ds.c_target_data,
             r_ui_d.output_directory,
-            quasi_idf,
+            quasi_idf_sets,
             excluded,
         )
         amd_plot_paths = amd_plot.save()
@@ -117,6 +124,9 @@ def privacy_score(
         rel_cdp_saved_file_paths = [
             "/".join(list(p.parts)[-2:]) for p in amd_plot_paths
         ]
+        # distribution of the first set, other sets are added after it
+        rel_cdp_saved_file_paths, other_set_paths = \
+            rel_cdp_saved_file_paths[:1], rel_cdp_saved_file_paths[1:]
 
         # Total rows matched on quasi-identifiers as attachment
         rec_matched = amd_plot.quasi_matched_df.shape[0]
@@ -148,6 +158,32 @@ def privacy_score(
             _type=AttachmentType.ImageLinks,
         )
 
+        other_sets_a = []
+        for quasi, matched_df, p in zip(quasi_idf_sets[1:],
+                                        amd_plot.quasi_matched_dfs[1:],
+                                        other_set_paths):
+            set_rec_matched = matched_df.shape[0]
+            set_rec_percent = round(set_rec_matched / ds.c_target_data.shape[0] * 100, 2)
+            other_sets_a.extend([
+                Attachment(
+                    name="Alternative Quasi-Identifiers",
+                    _data=", ".join(quasi),
+                    _type=AttachmentType.String,
+                ),
+                Attachment(
+                    name=None,
+                    _data=f"Number of Target Data records exactly matched "
+                    f"in Deid. Data on Quasi-Identifiers: "
+                    f"-Highlight-{set_rec_matched} ({set_rec_percent}%)-Highlight-",
+                    _type=AttachmentType.String,
+                ),
+                Attachment(
+                    name=None,
+                    _data=[{IMAGE_NAME: Path(p).stem, PATH: p}],
+                    _type=AttachmentType.ImageLinks,
+                ),
+            ])
+
         r_ui_d.add(
             PrivacyScorePacket(
                 "Apparent Match Distribution",
@@ -160,11 +196,54 @@ def privacy_score(
                     total_quasi_matched,
                     adp_para_a,
                     adp,
-                ],
+                ] + other_sets_a,
             )
         )
         log.end_msg()
 
+    log.msg("Distance to Closest Record", level=3)
+    dcr = DistanceToClosestRecord(
+        ds.t_target_data,
+        ds.t_synthetic_data,
+        r_ui_d.output_directory,
+        numeric_features=ds.continuous_features,
+        n_jobs=n_jobs,
+        max_rows=dcr_max_rows,
+    )
+    dcr.compute_score()
+    dcr_para_a = Attachment(name=None, _data=dcr_para, _type=AttachmentType.String)
+    dcr_dist_a = Attachment(
+        name="Distance to Closest Target Record",
+        _data=[
+            {"Quantile": q,
+             "Deid. to Target Records":
+                 dcr.dcr_dist.loc[q, "Deid. records to target records"],
+             "Deid. to Reference Records":
+                 dcr.dcr_dist.loc[q, "Deid. records to reference records"],
+             "Holdout to Reference Records":
+                 dcr.dcr_dist.loc[q, "Holdout records to reference records"]}
+            for q in dcr.quantiles
+        ],
+        _type=AttachmentType.Table,
+    )
+    dcr_closer_a = Attachment(
+        name=None,
+        _data=f"Deid. Data records at distance 0 from a Target Data record: "
+        f"-Highlight-{round(dcr.report_data['deid_exact_match_fraction'] * 100, 2)}%"
+        f"-Highlight-<br>"
+        f"Deid. Data records closer to the reference Target Data records than "
+        f"95% of the holdout Target Data records: "
+        f"-Highlight-{round(dcr.score * 100, 2)}%-Highlight-",
+        _type=AttachmentType.String,
+    )
+    r_ui_d.add(
+        PrivacyScorePacket(
+            "Distance to Closest Record", None, [dcr_para_a, dcr_dist_a, dcr_closer_a]
+        )
+    )
+    rd.add("distance_to_closest_record", dcr.report_data)
+    log.end_msg()
+
     stable_quasi_identifiers = ["RAC1P", "SEX"]
 
     can_compute_kdisco = set(stable_quasi_identifiers).issubset(set(ds.features))
@@ -174,11 +253,12 @@ def privacy_score(
         log.msg("DiSCO Score", level=3)
 
         disco_evaluator = KDiscoEvaluator(
-            gt_df=dataset.d_target_data.copy(),
-            syn_df=dataset.d_synthetic_data.copy(),
+            gt_df=dataset.d_target_data,
+            syn_df=dataset.d_synthetic_data,
             stable_identifiers=stable_quasi_identifiers,
             k=2,
-            output_directory=os.path.join(r_ui_d.output_directory, "kdisco")
+            output_directory=os.path.join(r_ui_d.output_directory, "kdisco"),
+            n_jobs=n_jobs
         )
         disco_evaluator.compute_k_disco()
 
@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import Optional, Tuple
 
 from sdnist.load import \
     TestDatasetName
@@ -24,14 +24,16 @@ from sdnist.utils import *
 
 
 def utility_score(dataset: Dataset, ui_data: ReportUIData, report_data: ReportData,
-                  log: SimpleLogger) \
+                  log: SimpleLogger, n_jobs: int = 1,
+                  baseline_dir: Optional[Path] = None,
+                  propensity_max_rows: Optional[int] = None) \
         -> Tuple[ReportUIData, ReportData]:
     ds = dataset
     r_ui_d = ui_data  # report ui data
     rd = report_data
 
     log.msg('Kmarginal', level=3)
-    kmr = KMarginalReport(ds, r_ui_d, rd)
+    kmr = KMarginalReport(ds, r_ui_d, rd, n_jobs, baseline_dir)
     kmr.compute()
     kmr.add_to_ui()
     log.end_msg()
@@ -115,7 +117,8 @@ def utility_score(dataset: Dataset, ui_data: ReportUIData, report_data: ReportDa
         log.end_msg()
 
     log.msg('PropensityMSE', level=3)
-    propensity = PropensityMSEReport(ds, r_ui_d, rd)
+    propensity = PropensityMSEReport(ds, r_ui_d, rd, n_jobs,
+                                     max_rows=propensity_max_rows)
     propensity.compute()
     propensity.add_to_ui()
     log.end_msg()
@@ -1,13 +1,19 @@
-from typing import Dict, List, Optional
+import itertools
+from typing import Dict, List, Optional, Tuple
 import pandas as pd
 from pathlib import Path
 
 from sdnist.report.report_data import \
     ReportData, ReportUIData, Attachment, AttachmentType, UtilityScorePacket
 from sdnist.report.dataset import Dataset, get_stable_features
-from sdnist.metrics.kmarginal import KMarginal
+from sdnist.metrics.encoding import sample_marginals
+from sdnist.metrics.kmarginal import \
+    KMarginal, MultiGroupKMarginal, TargetMarginalCache, marginals_sampled
 from sdnist.report.score.utility.interfaces.kmarginal.subsample_score import (
-    kmarginal_subsamples, kmarginal_stable_feature_subsamples)
+    kmarginal_subsamples, kmarginal_stable_feature_subsamples, SUBSAMPLE_SEED)
+from sdnist.report.score.utility.interfaces.kmarginal.baseline import (
+    baseline_path, baseline_target, load_baseline, save_baseline
+)
 from sdnist.report.score.utility.interfaces.kmarginal.stable_feature_scores import (
     best_worst_performing
 )
@@ -25,10 +31,16 @@ from sdnist.utils import create_path, save_data_frame, relative_path
 
 
 class KMarginalReport:
+    # tolerance on the 0 - 1000 k-marginal score when marginal pairs of wide
+    # datasets are sampled
+    SCORE_TOLERANCE = 5
+
     def __init__(self,
                  dataset: Dataset,
                  ui_data: ReportUIData,
-                 report_data: ReportData):
+                 report_data: ReportData,
+                 n_jobs: int = 1,
+                 baseline_dir: Optional[Path] = None):
         self.ds = dataset
         self.r_ui_d = ui_data
         self.rd = report_data
@@ -38,8 +50,25 @@ class KMarginalReport:
         self.stable_feature_values: Optional[Dict] = self.get_stable_feature_values(0)
 
         self.kmarginal_score = 0
+        # 95% confidence half-width of the score if marginal pairs are sampled
+        self.kmarginal_score_error: Optional[float] = None
+        self.kmarginal_n_marginals = 0
+        # marginal pairs of the deidentified data score when they are sampled
+        # adaptively, so the other stable feature scores use as many pairs
+        self.kmarginal_marginals: Optional[List[Tuple[str, ...]]] = None
+        self.kmarginal_seed = 0
         self.kmarginal_stable_feature_scores = None
 
+        # target marginals shared by all the k-marginal computations of this report
+        self.target_cache = TargetMarginalCache()
+        # number of worker processes of k-marginal computations
+        self.n_jobs = n_jobs
+        # directory in which subsample baselines are saved and reused across
+        # reports, baselines are not saved if None
+        self.baseline_dir = baseline_dir
+        # target data binned on its own values, on which baselines are scored
+        self._baseline_target: Optional[pd.DataFrame] = None
+
         self.stable_feature_worst_scores: List[Dict] = []
         self.stable_feature_best_score: List[Dict] = []
 
@@ -69,9 +98,17 @@ class KMarginalReport:
 
         k_marginal = KMarginal(self.ds.d_target_data,
                                self.ds.d_synthetic_data,
-                               sf)
+                               sf,
+                               target_cache=self.target_cache,
+                               n_jobs=self.n_jobs,
+                               tolerance=self.SCORE_TOLERANCE)
         k_marginal.compute_score()
         self.kmarginal_score = int(k_marginal.score)
+        self.kmarginal_score_error = k_marginal.score_error
+        self.kmarginal_n_marginals = len(k_marginal.marginals)
+        if k_marginal.adaptive:
+            self.kmarginal_marginals = [tuple(m) for m in k_marginal.marginals]
+            self.kmarginal_seed = k_marginal.seed
 
         self.subsample_scores, self.subsample_stable_feature_score = \
             self.compute_subsample_kmarginal_scores(sf)
@@ -89,11 +126,53 @@ class KMarginalReport:
             self.compute_other_stable_features_scores()
         return k_marginal
 
-    def compute_subsample_kmarginal_scores(self, stable_feature: Optional[str]):
+    def group_feature_marginals(self, group_feature: str) \
+            -> Optional[List[Tuple[str, ...]]]:
+        """
+        Marginal pairs of another group feature when the deidentified data score
+        pairs are sampled adaptively: as many distinct pairs of the other
+        features, sampled the same way. None to use the default pairs.
+        """
+        if self.kmarginal_marginals is None:
+            return None
+        marg_cols = sorted(set(self.ds.d_target_data.columns).difference({group_feature}))
+        if not marginals_sampled(len(marg_cols), 2):
+            return None
+        return list(itertools.islice(sample_marginals(marg_cols, 2,
+                                                      self.kmarginal_seed),
+                                     len(self.kmarginal_marginals)))
+
+    @property
+    def baseline_target(self) -> pd.DataFrame:
+        if self._baseline_target is None:
+            self._baseline_target = baseline_target(self.ds.t_target_data,
+                                                    self.ds.data_dict)
+        return self._baseline_target
 
-        subsample_scores = kmarginal_subsamples(self.ds.d_target_data, stable_feature)
+    def compute_subsample_kmarginal_scores(self, stable_feature: Optional[str]):
+        # subsample baselines only depend on the target data: they are scored
+        # on target only bins and the default marginal pairs, so the baseline
+        # saved by an earlier report on the same target is reused if any
+        target = self.baseline_target
+        b_path = None
+        if self.baseline_dir is not None:
+            b_path = baseline_path(self.baseline_dir,
+                                   self.ds.test.name,
+                                   target,
+                                   stable_feature,
+                                   SUBSAMPLE_SEED)
+            baseline = load_baseline(b_path)
+            if baseline is not None:
+                return baseline
+
+        subsample_scores = kmarginal_subsamples(target,
+                                                stable_feature,
+                                                self.target_cache,
+                                                seed=SUBSAMPLE_SEED)
         subsample_stable_feature_score = kmarginal_stable_feature_subsamples(
-            self.ds.d_target_data, stable_feature)
+            target, stable_feature, self.target_cache, seed=SUBSAMPLE_SEED)
+        if b_path is not None:
+            save_baseline(b_path, subsample_scores, subsample_stable_feature_score)
         return subsample_scores, subsample_stable_feature_score
 
     def get_stable_feature_values(self, index: int):
@@ -109,18 +188,24 @@ class KMarginalReport:
             return None
 
     def compute_other_stable_features_scores(self):
+        # group scores of all other stable features from one pass over the pairs
+        group_marginals = {sf: self.group_feature_marginals(sf)
+                           for sf in self.stable_features[1:]}
+        group_marginals = {sf: m for sf, m in group_marginals.items() if m is not None}
+        k_marginal = MultiGroupKMarginal(self.ds.d_target_data,
+                                         self.ds.d_synthetic_data,
+                                         self.stable_features[1:],
+                                         target_cache=self.target_cache,
+                                         n_jobs=self.n_jobs,
+                                         group_marginals=group_marginals)
+        k_marginal.compute_score()
         for i, sf in enumerate(self.stable_features[1:]):
             stable_feature_values = self.get_stable_feature_values(i + 1)
-            k_marginal = KMarginal(self.ds.d_target_data,
-                                   self.ds.d_synthetic_data,
-                                   sf)
-            k_marginal.compute_score()
-            stable_feature_scores = k_marginal.scores
             _, subsample_stable_feature_score = \
                 self.compute_subsample_kmarginal_scores(sf)
             o_worst, o_best = (
                 best_worst_performing(
-                    k_marginal.scores,
+                    k_marginal.scores[sf],
                     subsample_stable_feature_score,
                     self.ds,
                     sf,
@@ -233,7 +318,24 @@ class KMarginalReport:
                            _data=f"Highlight-K-Marginal Score: {self.kmarginal_score}",
                            _type=AttachmentType.String)
 
-        attachments = [kmp_a, kms_a, ss_para_a, ssf_a, sed_a]
+        attachments = [kmp_a, kms_a]
+        if self.kmarginal_score_error is not None:
+            # error bound of the score computed from sampled marginal pairs
+            kme_a = Attachment(name=None,
+                               _data=f"K-Marginal score is computed from "
+                                     f"{self.kmarginal_n_marginals} sampled feature pairs, "
+                                     f"-Highlight-\u00B1 {round(self.kmarginal_score_error, 2)}"
+                                     f"-Highlight- at 95% confidence. "
+                                     f"Sub-sample scores are computed from the default "
+                                     f"pairs of the target data."
+                                     + (f" The bound is of the overall score only: "
+                                        f"the score of each {self.stable_features[0]} "
+                                        f"is computed from the same pairs, and its "
+                                        f"sampling error may be larger."
+                                        if self.stable_features else ""),
+                               _type=AttachmentType.String)
+            attachments.append(kme_a)
+        attachments.extend([ss_para_a, ssf_a, sed_a])
 
         if self.stable_features:
             # all score attachment
@@ -294,6 +396,9 @@ class KMarginalReport:
         k_marg_rd['sub_sampling_percent_equivalent'] = (
             int(subsample_equivalent * 100))
         k_marg_rd['k_marginal_score'] = self.kmarginal_score
+        if self.kmarginal_score_error is not None:
+            k_marg_rd['k_marginal_score_error'] = round(self.kmarginal_score_error, 2)
+            k_marg_rd['k_marginal_sampled_pairs'] = self.kmarginal_n_marginals
 
         self.rd.add('k_marginal', {
             "k_marginal_synopsys": k_marg_rd
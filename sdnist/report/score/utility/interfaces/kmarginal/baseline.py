@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import pandas as pd
+
+from sdnist.metrics.kmarginal import TargetMarginalCache
+from sdnist.report.dataset.binning import bin_data
+from sdnist.version import __version__
+
+
+def baseline_target(target: pd.DataFrame, data_dict: Dict) -> pd.DataFrame:
+    """
+    Transformed target data binned on its own values. Bins of the report's
+    binned target also depend on the deidentified data min and max, so
+    baselines are scored on these target only bins and can be reused for any
+    deidentified data.
+    """
+    return bin_data(target, target, data_dict)[0]
+
+
+def baseline_path(baseline_dir: Path,
+                  target_name: str,
+                  target: pd.DataFrame,
+                  stable_feature: Optional[str],
+                  seed: int) -> Path:
+    """
+    Path of the saved subsample baseline of a target dataset in baseline_dir.
+    Baselines depend on the target name, its evaluated features, the stable
+    feature, the seed and the sdnist version. The fingerprint of the target
+    data, binned with baseline_target, is also part of the key.
+    """
+    key = json.dumps({'target': target_name,
+                      'features': sorted(target.columns.tolist()),
+                      'stable_feature': stable_feature,
+                      'seed': seed,
+                      'version': __version__,
+                      'fingerprint': TargetMarginalCache.fingerprint(target)})
+    key_hash = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return Path(baseline_dir, f'{target_name}_{key_hash}.json')
+
+
+def load_baseline(path: Path) \
+        -> Optional[Tuple[Dict[float, int], Optional[pd.Series]]]:
+    if not path.exists():
+        return None
+    try:
+        with open(path, 'r') as f:
+            baseline = json.load(f)
+        subsample_scores = {float(frac): score
+                            for frac, score in baseline['subsample_scores'].items()}
+        sf_scores = baseline['stable_feature_scores']
+        if sf_scores is None:
+            return subsample_scores, None
+        stable_feature_scores = pd.Series(sf_scores['values'],
+                                          index=pd.Index(sf_scores['index'],
+                                                         dtype=sf_scores['dtype'],
+                                                         name=sf_scores['name']))
+    except (OSError, json.JSONDecodeError, KeyError, TypeError, ValueError):
+        # unreadable or malformed baseline, it is recomputed
+        return None
+    return subsample_scores, stable_feature_scores
+
+
+def save_baseline(path: Path,
+                  subsample_scores: Dict[float, int],
+                  stable_feature_scores: Optional[pd.Series]):
+    sf_scores = None
+    if stable_feature_scores is not None:
+        sf_scores = {'name': stable_feature_scores.index.name,
+                     'dtype': str(stable_feature_scores.index.dtype),
+                     'index': stable_feature_scores.index.tolist(),
+                     'values': stable_feature_scores.values.tolist()}
+    baseline = {'version': __version__,
+                'subsample_scores': {str(frac): score
+                                     for frac, score in subsample_scores.items()},
+                'stable_feature_scores': sf_scores}
+    tmp_path = None
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # written to a temporary file then moved in place, so that reports
+        # running in parallel never read a partly written baseline
+        with tempfile.NamedTemporaryFile('w', dir=path.parent, prefix=f'.{path.stem}',
+                                         suffix='.tmp', delete=False) as f:
+            tmp_path = f.name
+            json.dump(baseline, f, indent=4)
+        os.replace(tmp_path, path)
+    except OSError:
+        # baselines are only a cache, the directory may be read only
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -1,26 +1,46 @@
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 
-from sdnist.metrics.kmarginal import KMarginal
+from sdnist.metrics.kmarginal import \
+    KMarginal, SubsampleKMarginal, TargetMarginalCache
 
+# seed of the target subsamples, so that the subsample baselines of a target
+# dataset are reproducible and can be saved
+SUBSAMPLE_SEED = 0
 
-def create_subsample(data: pd.DataFrame, frac: float):
-    s = data.sample(frac=frac)  # subsample as synthetic data
+
+def create_subsample(data: pd.DataFrame, frac: float,
+                     rng: Optional[np.random.Generator] = None):
+    s = data.sample(frac=frac, random_state=rng)  # subsample as synthetic data
     return s
 
 
+def create_subsample_rows(n_rows: int, frac: float,
+                          rng: np.random.Generator) -> np.ndarray:
+    # row positions of a subsample of the same size as data.sample(frac=frac)
+    return rng.choice(n_rows, size=int(round(frac * n_rows)), replace=False)
+
+
 def kmarginal_stable_feature_subsamples(target: pd.DataFrame,
-                                        stable_feature: Optional[str]) \
+                                        stable_feature: Optional[str],
+                                        target_cache: Optional[TargetMarginalCache] = None,
+                                        materialize: bool = False,
+                                        seed: Optional[int] = SUBSAMPLE_SEED,
+                                        marginals: Optional[List[Tuple[str, ...]]] = None) \
         -> pd.DataFrame:
     ss_km_runs: int = 5  # subsample kmarginal runs
     stable_feature_scores = None
-    if stable_feature:
+    rng = np.random.default_rng(seed)
+    if stable_feature and materialize:
         for i in range(ss_km_runs):
-            s_sd = create_subsample(target, frac=0.4)
+            s_sd = create_subsample(target, frac=0.4, rng=rng)
             s_kmarg = KMarginal(target,
                                 s_sd,
-                                stable_feature)
+                                stable_feature,
+                                target_cache=target_cache,
+                                marginals=marginals)
             s_kmarg.compute_score()
             scores = s_kmarg.scores
             if stable_feature_scores is None:
@@ -28,23 +48,60 @@ def kmarginal_stable_feature_subsamples(target: pd.DataFrame,
             else:
                 stable_feature_scores += scores
         stable_feature_scores /= ss_km_runs
+    elif stable_feature:
+        subsamples = [create_subsample_rows(target.shape[0], 0.4, rng)
+                      for _ in range(ss_km_runs)]
+        s_kmarg = SubsampleKMarginal(target,
+                                     subsamples,
+                                     stable_feature,
+                                     target_cache=target_cache,
+                                     marginals=marginals)
+        s_kmarg.compute_score()
+        for i in range(ss_km_runs):
+            scores = s_kmarg.scores[i].rename(None)
+            if stable_feature_scores is None:
+                stable_feature_scores = scores
+            else:
+                stable_feature_scores += scores
+        stable_feature_scores /= ss_km_runs
     return stable_feature_scores
 
 
 def kmarginal_subsamples(target: pd.DataFrame,
-                         stable_feature: Optional[str] = None) \
+                         stable_feature: Optional[str] = None,
+                         target_cache: Optional[TargetMarginalCache] = None,
+                         materialize: bool = False,
+                         seed: Optional[int] = SUBSAMPLE_SEED,
+                         marginals: Optional[List[Tuple[str, ...]]] = None) \
         -> Dict[float, int]:
-    # mapping of subsample frac to k-marginal score of fraction
+    # mapping of subsample frac to k-marginal score of fraction, scored on
+    # marginals if given, e.g. those of the deidentified data score
     sub_sample_score = dict()   # subsample scores dictionary
     # find k-marginal of 1%, 5%, 10%, 20% ... 90% of sub-sample of target data
     sample_sizes = [1, 5] + [i*10 for i in range(1, 10)]
-    for i in sample_sizes:
-        # using subsample of target data as synthetic data
-        s_sd = create_subsample(target, frac= i * 0.01)
-        s_kmarg = KMarginal(target,
-                            s_sd,
-                            stable_feature)
+    rng = np.random.default_rng(seed)
+    if materialize:
+        for i in sample_sizes:
+            # using subsample of target data as synthetic data
+            s_sd = create_subsample(target, frac= i * 0.01, rng=rng)
+            s_kmarg = KMarginal(target,
+                                s_sd,
+                                stable_feature,
+                                target_cache=target_cache,
+                                marginals=marginals)
+            s_kmarg.compute_score()
+            s_score = int(s_kmarg.score)
+            sub_sample_score[i * 0.01] = s_score
+    else:
+        # using row positions of subsamples of target data as synthetic data
+        subsamples = [create_subsample_rows(target.shape[0], i * 0.01, rng)
+                      for i in sample_sizes]
+        s_kmarg = SubsampleKMarginal(target,
+                                     subsamples,
+                                     stable_feature,
+                                     target_cache=target_cache,
+                                     marginals=marginals)
         s_kmarg.compute_score()
-        s_score = int(s_kmarg.score)
-        sub_sample_score[i * 0.01] = s_score
-    return sub_sample_score
\ No newline at end of file
+        for i, s_score in zip(sample_sizes, s_kmarg.score):
+            sub_sample_score[i * 0.01] = int(s_score)
+    return sub_sample_score
@@ -1,11 +1,12 @@
 from pathlib import Path
+from typing import Optional
 
 from sdnist.report.dataset import Dataset
 from sdnist.report.report_data import \
     ReportData, ReportUIData, UtilityScorePacket, Attachment, AttachmentType
 from sdnist.report.plots.propensity import PropensityDistribution
 from sdnist.metrics.propensity import \
-    PropensityMSE
+    PropensityMSE, TREE
 from sdnist.report.score.paragraphs import propensity_para
 import sdnist.strs as strs
 
@@ -14,7 +15,11 @@ class PropensityMSEReport:
     def __init__(self,
                  dataset: Dataset,
                  ui_data: ReportUIData,
-                 report_data: ReportData):
+                 report_data: ReportData,
+                 n_jobs: int = 1,
+                 classifier: str = TREE,
+                 n_folds: Optional[int] = None,
+                 max_rows: Optional[int] = None):
         self.ds = dataset
         self.r_ui_d = ui_data
         self.rd = report_data
@@ -23,7 +28,11 @@ class PropensityMSEReport:
             self.ds.t_target_data,
             self.ds.t_synthetic_data,
             self.r_ui_d.output_directory,
-            self.ds.features)
+            self.ds.features,
+            classifier=classifier,
+            n_folds=n_folds,
+            n_jobs=n_jobs,
+            max_rows=max_rows)
         self.pp = None
 
         self.propensity_score = 0
@@ -59,7 +68,19 @@ class PropensityMSEReport:
                                  for p in rel_pd_path],
                           _type=AttachmentType.ImageLinks)
 
+        attachments = [pd_para_a, pd_score_a, pd_a]
+        if self.p.pmse_spread is not None:
+            attachments.insert(2, Attachment(
+                name=None,
+                _data=f"Computed on a subsample of "
+                      f"{round(self.p.sampling_fraction * 100, 2)}% of the target "
+                      f"and deidentified records. The score varies by "
+                      f"\u00B1 {round(self.p.pmse_spread, 4)} over "
+                      f"{self.p.n_subsamples} classifiers refitted on other "
+                      f"subsamples of the same size.",
+                _type=AttachmentType.String))
+
         prop_pkt = UtilityScorePacket(self.p.NAME,
                                       None,
-                                      [pd_para_a, pd_score_a, pd_a])
+                                      attachments)
         self.r_ui_d.add(prop_pkt)
@@ -1,4 +1,5 @@
 ALL_COMPONENTS_PAIR_PLOT = 'all_components_pair_plot'
+BASELINE_DIR = 'baseline_dir'
 BIAS_PENALTY_CUTOFF = 'bias_penalty_cutoff'
 BINS = 'bins'
 CATEGORICAL = 'categorical'
@@ -14,6 +15,7 @@ DATA = 'data'
 DATA_DESCRIPTION = 'data_description'
 DATA_ROOT = 'data_root'
 DATASET_NAME = 'dataset_name'
+DCR_MAX_ROWS = 'dcr_max_rows'
 DIVERGENCE = 'divergence'
 DOWNLOAD = 'download'
 DROP_FEATURES = 'drop_features'
@@ -31,9 +33,11 @@ K_MARGINAL = 'k_marginal'
 LABELS_DICT = 'labels_dict'
 MAX = 'max'
 MIN = 'min'
+N_JOBS = 'n_jobs'
 NULL_VALUE = 'null_value'
 OUTPUT_DIRECTORY = 'output_directory'
 PATH = 'path'
+PROPENSITY_MAX_ROWS = 'propensity_max_rows'
 PUBLIC = 'public'
 SCHEMA = 'schema'
 SCORE = 'score'
@@ -0,0 +1,50 @@
+from typing import Callable, Dict, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def random_data(n: int, seed: int,
+                columns: Dict[str, Sequence],
+                dtypes: Optional[Dict[str, str]] = None,
+                missing: Optional[Dict[str, float]] = None) -> pd.DataFrame:
+    """
+    Seeded random records. Values of a column given as a range are integers
+    of the range, values of a column given as a list are drawn from the list.
+    dtypes are the dtypes the columns are cast to, and missing the fraction of
+    the records of a column whose values are set missing.
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        c: rng.integers(v.start, v.stop, size=n) if isinstance(v, range)
+        else rng.choice(v, size=n)
+        for c, v in columns.items()
+    })
+    if dtypes:
+        df = df.astype(dtypes)
+    for c, frac in (missing or {}).items():
+        df[c] = df[c].astype(float)
+        df.loc[rng.random(n) < frac, c] = np.nan
+    return df
+
+
+def data_factory(columns: Dict[str, Sequence],
+                 dtypes: Optional[Dict[str, str]] = None,
+                 missing: Optional[Dict[str, float]] = None) \
+        -> Callable[[int, int], pd.DataFrame]:
+    def make_data(n: int, seed: int) -> pd.DataFrame:
+        return random_data(n, seed, columns, dtypes, missing)
+    return make_data
+
+
+@pytest.fixture
+def make_data(request) -> Callable[[int, int], pd.DataFrame]:
+    """
+    make_data(n, seed) of records with the COLUMNS of the test module, cast
+    to its DTYPES and with its MISSING fractions of missing values.
+    """
+    module = request.module
+    return data_factory(module.COLUMNS,
+                        getattr(module, "DTYPES", None),
+                        getattr(module, "MISSING", None))
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+from sdnist.metrics.apparent_match_dist import cellchange, match
+from sdnist.report.plots import ApparentMatchDistributionPlot
+from sdnist.test.conftest import data_factory
+
+
+COLUMNS = {"SEX": range(1, 3),
+           "RAC1P": range(1, 5),
+           "EDU": range(-1, 12),
+           "PUMA": ["01-01301", "06-07502", "17-03529"],
+           "AGEP": range(0, 20),
+           "INDP": ["170", "770", "N"]}
+MISSING = {"EDU": 0.05}
+
+
+def reference_cellchange(df1, df2, quasi, exclude_cols):
+    # reference implementation with drop_duplicates, merge and column loop
+    uniques1 = df1.drop_duplicates(subset=quasi, keep=False)
+    uniques2 = df2.drop_duplicates(subset=quasi, keep=False)
+    matcheduniq = uniques1.merge(uniques2, how='inner', on=quasi)
+    cols = set(df1.columns).intersection(set(df2.columns)) - set(quasi) - set(exclude_cols)
+    S = pd.Series(data=0, index=matcheduniq.index)
+    for c in cols:
+        S = S + (matcheduniq[c + "_x"] == matcheduniq[c + "_y"]).astype(int)
+    return (S / len(cols)) * 100, uniques1, uniques2, matcheduniq
+
+
+def test_cellchange(make_data):
+    df1, df2 = make_data(3000, 0), make_data(2000, 1)
+    # records of df1 with some changed values
+    df2.iloc[:500, 4:] = df1.iloc[:500, 4:].values
+    for quasi, exclude in [(["SEX", "RAC1P", "EDU", "PUMA", "AGEP"], []),
+                           (["SEX", "EDU", "PUMA", "INDP", "AGEP"], ["RAC1P"])]:
+        percents, u1, u2, mu = cellchange(df1, df2, quasi, exclude)
+        r_percents, r_u1, r_u2, r_mu = reference_cellchange(df1, df2, quasi, exclude)
+        assert len(percents) > 0
+        pd.testing.assert_series_equal(percents, r_percents)
+        pd.testing.assert_frame_equal(u1, r_u1)
+        pd.testing.assert_frame_equal(u2, r_u2)
+        pd.testing.assert_frame_equal(mu, r_mu)
+        cols = set(df1.columns) - set(quasi) - set(exclude)
+        pd.testing.assert_series_equal(match(mu, cols), r_percents)
+
+
+def test_missing_values(make_data):
+    matched = pd.DataFrame({
+        "A_x": pd.Series([1, None, None, pd.NA], dtype=object),
+        "A_y": pd.Series([1, None, 2, pd.NA], dtype=object),
+        "B_x": pd.Series(["a", "b", pd.NA, "c"], dtype=object),
+        "B_y": pd.Series(["a", "c", pd.NA, "c"], dtype=object),
+    })
+    # missing values never match
+    assert match(matched, ["A", "B"]).tolist() == [100, 0, 0, 50]
+
+    df1, df2 = make_data(3000, 0), make_data(2000, 1)
+    df2.iloc[:500, 4:] = df1.iloc[:500, 4:].values
+    for df in [df1, df2]:
+        df["INDP"] = df["INDP"].astype(object)
+        df.loc[df.index[:200:2], "INDP"] = None
+        df.loc[df.index[1:200:2], "INDP"] = pd.NA
+    quasi = ["SEX", "RAC1P", "EDU", "PUMA", "AGEP"]
+    percents, _, _, mu = cellchange(df1, df2, quasi, [])
+    cols = set(df1.columns) - set(quasi)
+    pd.testing.assert_series_equal(match(mu, cols), percents)
+
+
+def test_quasi_identifier_sets(make_data, tmp_path):
+    df1, df2 = make_data(3000, 0), make_data(2000, 1)
+    df2.iloc[:500, 4:] = df1.iloc[:500, 4:].values
+    quasi_sets = [["SEX", "RAC1P", "EDU", "PUMA", "AGEP"],
+                  ["SEX", "RAC1P", "EDU", "AGEP"],
+                  ["INDP", "AGEP", "EDU"]]
+    amd_plot = ApparentMatchDistributionPlot(df1, df2, tmp_path, quasi_sets, [])
+    paths = amd_plot.save()
+    assert len(paths) == len(amd_plot.quasi_matched_dfs) == 3
+    assert all(p.exists() for p in paths)
+    assert len(amd_plot.report_data["quasi_identifier_sets"]) == 3
+    # one distribution per set, as computed for each set alone
+    for quasi, matched_df in zip(quasi_sets, amd_plot.quasi_matched_dfs):
+        percents, _, _, mu = reference_cellchange(df1, df2, quasi, [])
+        mu["percent_match"] = percents
+        pd.testing.assert_frame_equal(matched_df, mu)
+
+
+if __name__ == "__main__":
+    import tempfile
+    from pathlib import Path
+    make_data = data_factory(COLUMNS, missing=MISSING)
+    test_cellchange(make_data)
+    test_missing_values(make_data)
+    test_quasi_identifier_sets(make_data, Path(tempfile.mkdtemp()))
@@ -0,0 +1,92 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from sdnist.metrics.dcr import DistanceToClosestRecord, closest_record_distances
+
+
+COLUMNS = {"PUMA": ["01-01301", "06-07502", "17-03529"],
+           "SEX": range(1, 3),
+           "EDU": range(-1, 12),
+           "AGEP": range(0, 90),
+           "PINCP": range(0, 200000)}
+DTYPES = {"AGEP": float}
+MISSING = {"PINCP": 0.1}
+
+
+def reference_distances(x: pd.DataFrame, y: pd.DataFrame, numeric_features) -> np.ndarray:
+    # reference implementation comparing every pair of records
+    numeric = pd.concat([x, y])[numeric_features]
+    ranges = (numeric.max() - numeric.min()).replace(0, 1)
+    dist = np.zeros((x.shape[0], y.shape[0]))
+    for f in x.columns:
+        x_f, y_f = x[f].values[:, None], y[f].values[None, :]
+        if f in numeric_features:
+            x_f, y_f = x_f.astype(float), y_f.astype(float)
+            d = np.abs(x_f - y_f) / ranges[f]
+            both = np.isnan(x_f) & np.isnan(y_f)
+            dist += np.where(np.isnan(d), np.where(both, 0, 1), d)
+        else:
+            dist += (x_f != y_f) & ~(pd.isna(x_f) & pd.isna(y_f))
+    return dist.min(axis=1) / x.shape[1]
+
+
+def test_closest_record_distances(make_data):
+    x, y = make_data(700, 0), make_data(900, 1)
+    x.iloc[:50] = y.iloc[100:150].values
+    for numeric_features in [[], ["AGEP", "PINCP"]]:
+        expected = reference_distances(x, y, numeric_features)
+        # small tiles split both datasets in several tiles
+        for n_jobs in [1, 2]:
+            dcr = closest_record_distances(x, y, numeric_features,
+                                           n_jobs=n_jobs, tile_bytes=1 << 16)
+            assert np.allclose(dcr, expected, atol=1e-6)
+            assert (dcr[:50] == 0).all()
+        assert np.allclose(closest_record_distances(x, y, numeric_features),
+                           expected, atol=1e-6)
+
+
+def test_distance_to_closest_record(make_data, tmp_path: Path):
+    target = make_data(2000, 0)
+    # copies of target records are closer to the target data than held out records
+    dcr = DistanceToClosestRecord(target, target.iloc[:500], tmp_path,
+                                  numeric_features=["AGEP", "PINCP"])
+    dcr.compute_score()
+    assert dcr.report_data["distance"] == "gower"
+    assert dcr.report_data["holdout_records"] == 1000
+    # copies of held out records are at distance 0 from the target data too
+    assert dcr.report_data["deid_exact_match_fraction"] == 1
+    assert (dcr.deid_dcr == 0).all()
+    assert np.allclose(dcr.deid_dcr,
+                       reference_distances(target.iloc[:500], target, ["AGEP", "PINCP"]),
+                       atol=1e-6)
+    assert dcr.score > 0.4
+    assert Path(tmp_path, dcr.report_data["dcr_distribution"]).exists()
+
+    deid = make_data(500, 1)
+    dcr = DistanceToClosestRecord(target, deid, tmp_path)
+    dcr.compute_score()
+    assert np.allclose(dcr.deid_dcr, reference_distances(deid, target, []), atol=1e-6)
+    assert dcr.report_data["distance"] == "hamming"
+    assert dcr.score < 0.2
+
+
+def test_sampled_distance_to_closest_record(make_data, tmp_path: Path):
+    target, deid = make_data(1000, 0), make_data(800, 1)
+    dcr = DistanceToClosestRecord(target, deid, tmp_path, max_rows=300)
+    assert dcr.score == 0
+    dcr.compute_score()
+    assert dcr.report_data["deid_records"] == 300
+    assert dcr.report_data["holdout_records"] == 300
+    sample = dcr.sample(deid)
+    # the same seeded records are sampled by each computation
+    assert sample.index.equals(dcr.sample(deid).index)
+    assert sample.index.is_monotonic_increasing
+    assert np.allclose(dcr.deid_dcr, reference_distances(sample, target, []), atol=1e-6)
+
+    # all the records are scored without max_rows
+    dcr = DistanceToClosestRecord(target, deid, tmp_path, max_rows=None)
+    dcr.compute_score()
+    assert dcr.report_data["deid_records"] == 800
+    assert dcr.report_data["holdout_records"] == 500
@@ -0,0 +1,170 @@
+import numpy as np
+import pandas as pd
+
+from sdnist.metrics.disco import \
+    KDiscoEvaluator, compute_quasi_identifiers, disco_dio_scores
+from sdnist.metrics.encoding import pack_quasi_identifiers
+from sdnist.test.conftest import data_factory
+
+
+COLUMNS = {"RAC1P": range(1, 4),
+           "SEX": range(1, 3),
+           "AGEP": range(0, 10),
+           "EDU": range(-1, 4),
+           "PUMA": ["01-01301", "06-07502", "17-03529"]}
+
+
+def reference_disco_dio(gt: pd.DataFrame, syn: pd.DataFrame, qids, target):
+    # reference DiSCO and DiO with string quasi-identifiers and row-wise matching
+    gt, syn = gt.copy(), syn.copy()
+    gt["qid"] = compute_quasi_identifiers(gt, qids)
+    syn["qid"] = compute_quasi_identifiers(syn, qids)
+    disclosive_in_synthetic = syn[syn.groupby("qid")[target].transform("nunique") == 1]
+    dis_mapping = disclosive_in_synthetic.groupby("qid")[target].unique().to_dict()
+    potential = gt[gt["qid"].isin(disclosive_in_synthetic["qid"])]
+    match = potential.apply(lambda x: x[target] == dis_mapping[x["qid"]][0], axis=1)
+    disco = (match[match == True].count() if match.shape[0] > 0 else 0) / gt.shape[0]  # noqa: E712
+    dio = gt[gt.groupby("qid")[target].transform("nunique") == 1].shape[0] / gt.shape[0]
+    return disco, dio
+
+
+def make_disclosive_data(make_data, n: int, seed: int) -> pd.DataFrame:
+    # features mostly determined by other features, so that many groups are disclosive
+    df = make_data(n, seed)
+    df["AGEP"] = df["AGEP"] // 3
+    noise = df.sample(frac=0.1, random_state=seed).index
+    df["EDU"] = (df["AGEP"] + df["SEX"]) % 4
+    df.loc[noise, "EDU"] = -1
+    df["PUMA"] = np.array(["01-01301", "06-07502", "17-03529"])[df["RAC1P"] - 1]
+    df.loc[noise[:len(noise) // 2], "PUMA"] = "17-03529"
+    df.loc[df.sample(frac=0.05, random_state=seed + 1).index, "EDU"] = np.nan
+    return df
+
+
+def test_disco_dio(make_data, tmp_path):
+    gt = make_disclosive_data(make_data, 400, 0)
+    syn = make_disclosive_data(make_data, 300, 1)
+    evaluator = KDiscoEvaluator(gt.copy(), syn.copy(), ["RAC1P", "SEX"], k=1,
+                                output_directory=tmp_path)
+    evaluator.compute_k_disco()
+    for target, results in evaluator.disco_metric_results.items():
+        for qids, disco in results.items():
+            ref_disco, ref_dio = reference_disco_dio(gt, syn, list(qids), target)
+            assert disco == ref_disco
+            assert evaluator.dio_metric_results[target][qids] == ref_dio
+            assert evaluator.compute_disco(list(qids), target) == ref_disco
+            assert evaluator.compute_dio(list(qids), target) == ref_dio
+    # quasi-identifier keys are not added to the data
+    assert evaluator.gt_df.columns.tolist() == gt.columns.tolist()
+    assert evaluator.syn_df.columns.tolist() == syn.columns.tolist()
+
+
+def test_fused_disco_dio(make_data, tmp_path):
+    gt = make_disclosive_data(make_data, 400, 0)
+    syn = make_disclosive_data(make_data, 300, 1)
+    # missing values in a quasi-identifier and in the targets
+    gt.loc[gt.sample(frac=0.05, random_state=2).index, "AGEP"] = np.nan
+    syn.loc[syn.sample(frac=0.05, random_state=3).index, "PUMA"] = np.nan
+    gt.loc[gt.sample(frac=0.2, random_state=4).index, "EDU"] = np.nan
+    syn.loc[syn.sample(frac=0.2, random_state=5).index, "EDU"] = np.nan
+    evaluator = KDiscoEvaluator(gt, syn, ["RAC1P", "SEX"], output_directory=tmp_path)
+    features = gt.columns.tolist()
+    for qids in [["AGEP"], ["AGEP", "SEX"], ["EDU", "PUMA", "SEX"],
+                 ["AGEP", "PUMA", "RAC1P", "SEX"]]:
+        targets = [f for f in features if f not in qids]
+        expected = [(evaluator.compute_disco(qids, t), evaluator.compute_dio(qids, t))
+                    for t in targets]
+        # one table of distinct values for all the targets of the quasi-identifiers,
+        # from quasi-identifier keys and from refined partitions
+        gt_key, syn_key = evaluator.quasi_identifier_keys(qids)
+        assert disco_dio_scores(gt_key, syn_key,
+                                [evaluator.feature_codes(t) for t in targets]) == expected
+        assert list(evaluator.compute_disco_dio(qids, targets).values()) == expected
+
+
+def test_parallel_disco_dio(make_data, tmp_path):
+    gt = make_disclosive_data(make_data, 400, 0)
+    syn = make_disclosive_data(make_data, 300, 1)
+    evaluator = KDiscoEvaluator(gt.copy(), syn.copy(), ["RAC1P"], k=2,
+                                output_directory=tmp_path)
+    evaluator.compute_k_disco()
+    p_evaluator = KDiscoEvaluator(gt.copy(), syn.copy(), ["RAC1P"], k=2,
+                                  output_directory=tmp_path, n_jobs=2)
+    p_evaluator.compute_k_disco()
+    for results, p_results in [
+        (evaluator.disco_metric_results, p_evaluator.disco_metric_results),
+        (evaluator.dio_metric_results, p_evaluator.dio_metric_results),
+    ]:
+        assert results == p_results
+        # same order of targets and quasi-identifiers, so same csv outputs
+        assert [(t, list(r)) for t, r in results.items()] == \
+            [(t, list(r)) for t, r in p_results.items()]
+
+
+def test_higher_k_disco_dio(make_data, tmp_path):
+    gt = make_disclosive_data(make_data, 400, 0)
+    syn = make_disclosive_data(make_data, 300, 1)
+    for i in range(4):
+        gt[f"X{i}"] = (gt["AGEP"] + i) % 3
+        syn[f"X{i}"] = (syn["AGEP"] + syn["SEX"] * i) % 3
+    evaluator = KDiscoEvaluator(gt, syn, ["RAC1P"], k=3, output_directory=tmp_path)
+    evaluator.compute_k_disco()
+    # partitions refined from smaller quasi-identifier sets give the same scores
+    for target, results in evaluator.disco_metric_results.items():
+        assert len(results) == 35  # 3 of the 7 other features
+        for qids, disco in list(results.items())[:5]:
+            ref_disco, ref_dio = reference_disco_dio(gt, syn, list(qids), target)
+            assert disco == ref_disco
+            assert evaluator.dio_metric_results[target][qids] == ref_dio
+
+    s_evaluator = KDiscoEvaluator(gt, syn, ["RAC1P"], k=3, output_directory=tmp_path,
+                                  max_combinations=10, seed=1)
+    s_evaluator.compute_k_disco()
+    qid_sets = {qids for results in s_evaluator.disco_metric_results.values()
+                for qids in results}
+    assert len(qid_sets) == 10
+    for target, results in s_evaluator.disco_metric_results.items():
+        for qids, disco in results.items():
+            assert target not in qids
+            assert disco == evaluator.disco_metric_results[target][qids]
+
+
+def test_quasi_identifiers(make_data):
+    df = make_data(500, 0)
+    qids = ["AGEP", "EDU", "PUMA"]
+    expected = df[qids].apply(lambda row: "-".join(row.values.astype(str)), axis=1)
+    assert compute_quasi_identifiers(df, qids).equals(expected)
+
+
+def test_quasi_identifier_keys(make_data, tmp_path):
+    gt, syn = make_data(500, 0), make_data(300, 1)
+    syn.loc[:10, "AGEP"] = 20  # values missing from the ground truth
+    evaluator = KDiscoEvaluator(gt, syn, ["RAC1P", "SEX"], output_directory=tmp_path)
+    qids = ["AGEP", "EDU", "PUMA", "SEX"]
+    gt_key, syn_key = evaluator.quasi_identifier_keys(qids)
+    gt_str = compute_quasi_identifiers(gt, qids).values
+    syn_str = compute_quasi_identifiers(syn, qids).values
+    # keys are equal when quasi-identifier values are equal
+    key = np.concatenate([gt_key, syn_key])
+    qid_str = np.concatenate([gt_str, syn_str])
+    assert (pd.factorize(key)[0] == pd.factorize(qid_str)[0]).all()
+
+
+def test_pack_overflow():
+    rng = np.random.default_rng(0)
+    codes = [rng.integers(0, 2 ** 20, size=1000) for _ in range(5)]
+    key = pack_quasi_identifiers(codes, [2 ** 20] * 5)
+    expected = pd.MultiIndex.from_arrays(codes).factorize()[0]
+    assert (pd.factorize(key)[0] == expected).all()
+
+
+if __name__ == "__main__":
+    import tempfile
+    make_data = data_factory(COLUMNS)
+    test_disco_dio(make_data, tempfile.mkdtemp())
+    test_fused_disco_dio(make_data, tempfile.mkdtemp())
+    test_parallel_disco_dio(make_data, tempfile.mkdtemp())
+    test_higher_k_disco_dio(make_data, tempfile.mkdtemp())
+    test_quasi_identifiers(make_data)
+    test_quasi_identifier_keys(make_data, tempfile.mkdtemp())
+    test_pack_overflow()
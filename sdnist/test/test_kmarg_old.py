@@ -0,0 +1,37 @@
+from sdnist.metrics.kmarg_old import CensusKMarginalScore, PrivateMarginalCache
+from sdnist.test.conftest import data_factory
+
+
+COLUMNS = {"PUMA": ["a", "b", "c"],
+           "AGE": range(0, 90),
+           "SEX": range(1, 3),
+           "EDU": range(0, 5)}
+SCHEMA = {"PUMA": {"values": ["a", "b", "c"]},
+          "AGE": {"min": 0},
+          "SEX": {"values": [1, 2]},
+          "EDU": {"min": 0}}
+BINS = {"AGE": {"first_bin_max": 10, "last_bin_min": 80, "bin_size": 10}}
+
+
+def test_private_cache(make_data):
+    private = make_data(3000, 0)
+    for group_features in [None, ["PUMA"]]:
+        cache = PrivateMarginalCache()
+        for seed in range(1, 4):
+            synthetic = make_data(2000, seed)
+            score = CensusKMarginalScore(private, synthetic, SCHEMA, bins=BINS,
+                                         discretize=True, group_features=group_features)
+            score.compute_score()
+            c_score = CensusKMarginalScore(private, synthetic, SCHEMA, bins=BINS,
+                                           discretize=True, group_features=group_features,
+                                           private_cache=cache)
+            c_score.compute_score()
+            assert c_score.score == score.score
+            assert c_score._private_dataset is cache.private_dataset
+        # private marginals are computed once for all the synthetic datasets
+        assert len(cache.marginals) == len(set(tuple(c) for c in score.columns()))
+
+
+if __name__ == "__main__":
+    make_data = data_factory(COLUMNS)
+    test_private_cache(make_data)
@@ -0,0 +1,321 @@
+import io
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+import sdnist.metrics.kmarginal as kmarginal
+from sdnist.metrics.kmarginal import \
+    KMarginal, MultiGroupKMarginal, SubsampleKMarginal, StreamingKMarginal, \
+    TargetMarginalCache, compute_marginal_densities, get_marginals, MAX_MARGINALS
+from sdnist.report.score.utility.interfaces.kmarginal.baseline import \
+    baseline_path, baseline_target, load_baseline, save_baseline
+from sdnist.report.score.utility.interfaces.kmarginal.subsample_score import \
+    kmarginal_subsamples, kmarginal_stable_feature_subsamples
+from sdnist.report.dataset.binning import bin_data
+from sdnist.test.conftest import data_factory
+
+
+COLUMNS = {"PUMA": ["01-01301", "06-07502", "17-03529"],
+           "AGEP": range(0, 20),
+           "SEX": range(1, 3),
+           "EDU": range(-1, 12),
+           "INDP": [-1, 170, 770, 8570, 9920]}
+
+
+def groupby_score(target: pd.DataFrame, deid: pd.DataFrame, marginals):
+    # reference implementation of the ungrouped score using pandas groupby
+    tdds = 0
+    for marg in marginals:
+        t_den = compute_marginal_densities(target, list(marg))
+        s_den = compute_marginal_densities(deid, list(marg))
+        tdds += t_den.subtract(s_den, fill_value=0).abs().sum()
+    return (2 - tdds / len(marginals)) * 500
+
+
+def test_score_matches_groupby(make_data):
+    target, deid = make_data(5000, 0), make_data(3000, 1)
+    k_marg = KMarginal(target, deid)
+    k_marg.compute_score()
+    assert k_marg.score == groupby_score(target, deid, k_marg.marginals)
+
+
+def test_grouped_scores(make_data):
+    target = make_data(5000, 0)
+    k_marg = KMarginal(target, target.copy(), "PUMA")
+    k_marg.compute_score()
+    assert k_marg.score == 1000
+    assert (k_marg.scores == 1000).all()
+    assert k_marg.scores.index.name == "PUMA"
+    assert sorted(k_marg.scores.index) == sorted(target["PUMA"].unique())
+
+    k_marg = KMarginal(target, make_data(3000, 1), "PUMA")
+    k_marg.compute_score()
+    assert (k_marg.scores < 1000).all()
+    assert 0 <= k_marg.score < 1000
+
+
+def test_target_cache(make_data):
+    target = make_data(5000, 0)
+    cache = TargetMarginalCache()
+    for seed in range(3):
+        deid = make_data(3000, seed + 1)
+        k_marg = KMarginal(target, deid, "PUMA")
+        k_marg.compute_score()
+        c_k_marg = KMarginal(target, deid, "PUMA", target_cache=cache)
+        c_k_marg.compute_score()
+        assert c_k_marg.score == k_marg.score
+        assert c_k_marg.scores.equals(k_marg.scores)
+    # target marginals are counted once for all the deidentified datasets
+    assert len(cache._counts) == len(k_marg.marginals)
+
+
+def test_parallel_scores(make_data):
+    target, deid = make_data(5000, 0), make_data(3000, 1)
+    for group_feature in [None, "PUMA"]:
+        k_marg = KMarginal(target, deid, group_feature)
+        k_marg.compute_score()
+        p_k_marg = KMarginal(target, deid, group_feature, n_jobs=2)
+        p_k_marg.compute_score()
+        assert p_k_marg.score == k_marg.score
+        if group_feature:
+            assert p_k_marg.scores.equals(k_marg.scores)
+
+
+def test_multi_group_scores(make_data):
+    target, deid = make_data(5000, 0), make_data(3000, 1)
+    group_features = ["PUMA", "SEX", "INDP"]
+    for n_jobs in [1, 2]:
+        m_k_marg = MultiGroupKMarginal(target, deid, group_features, n_jobs=n_jobs)
+        m_k_marg.compute_score()
+        for g in group_features:
+            k_marg = KMarginal(target, deid, g)
+            k_marg.compute_score()
+            assert m_k_marg.score[g] == k_marg.score
+            assert m_k_marg.scores[g].equals(k_marg.scores)
+
+
+def test_multi_group_sampled_pairs(make_data):
+    target, deid = make_data(5000, 0), make_data(3000, 1)
+    # 31 features, pairs are sampled with replacement and some are listed twice
+    for i in range(26):
+        target[f"X{i}"] = target["AGEP"].values[np.random.default_rng(i).permutation(5000)]
+        deid[f"X{i}"] = deid["EDU"].values[np.random.default_rng(i).permutation(3000)]
+    group_features = ["PUMA", "SEX"]
+    m_k_marg = MultiGroupKMarginal(target, deid, group_features)
+    assert any(len(set(p)) < len(p) for p in m_k_marg.group_pairs.values())
+    for n_jobs in [1, 2]:
+        m_k_marg = MultiGroupKMarginal(target, deid, group_features, n_jobs=n_jobs)
+        m_k_marg.compute_score()
+        for g in group_features:
+            k_marg = KMarginal(target, deid, g)
+            k_marg.compute_score()
+            assert m_k_marg.score[g] == k_marg.score
+            assert m_k_marg.scores[g].equals(k_marg.scores)
+
+
+def test_higher_order_scores(make_data):
+    target, deid = make_data(5000, 0), make_data(3000, 1)
+    for k in [3, 4]:
+        k_marg = KMarginal(target, deid, k=k)
+        k_marg.compute_score()
+        assert all(len(m) == k for m in k_marg.marginals)
+        assert k_marg.score == groupby_score(target, deid, k_marg.marginals)
+
+        k_marg = KMarginal(target, target.copy(), "PUMA", k=k)
+        k_marg.compute_score()
+        assert (k_marg.scores == 1000).all()
+
+
+def test_sampled_marginals():
+    features = [f"F{i}" for i in range(30)]
+    marginals = get_marginals(features, 4, 200, 0)
+    assert len(marginals) == 200
+    assert len(set(marginals)) == 200
+    assert all(len(set(m)) == 4 for m in marginals)
+    assert marginals == get_marginals(features, 4, 200, 0)
+    # all combinations when there are few of them
+    assert len(get_marginals(features[:10], 3, 200, 0)) == 120 <= MAX_MARGINALS
+
+
+def test_streaming_scores(make_data):
+    target, deid = make_data(5000, 0), make_data(3000, 1)
+    # deidentified values missing from the target data, and missing values
+    deid.loc[:100, "EDU"] = 20
+    deid["AGEP"] = deid["AGEP"].astype(float)
+    deid.loc[200:300, "AGEP"] = np.nan
+    csv = io.StringIO()
+    deid.to_csv(csv, index=False)
+    for group_feature in [None, "PUMA"]:
+        k_marg = KMarginal(target, deid, group_feature)
+        k_marg.compute_score()
+        s_k_marg = StreamingKMarginal(target, group_feature)
+        csv.seek(0)
+        for chunk in pd.read_csv(csv, chunksize=700, dtype={"PUMA": str}):
+            s_k_marg.update(chunk)
+        assert s_k_marg.finalize() == k_marg.score
+        if group_feature:
+            assert s_k_marg.scores.equals(k_marg.scores)
+
+
+def test_adaptive_sampling(make_data):
+    target, deid = make_data(5000, 0), make_data(3000, 1)
+    # 31 features, pairs of wide datasets are sampled
+    for i in range(26):
+        target[f"X{i}"] = target["AGEP"].values[np.random.default_rng(i).permutation(5000)]
+        deid[f"X{i}"] = deid["EDU"].values[np.random.default_rng(i).permutation(3000)]
+    k_marg = KMarginal(target, deid, tolerance=20)
+    k_marg.compute_score()
+    assert len(set(k_marg.marginals)) == len(k_marg.marginals)
+    assert all(f1 != f2 for f1, f2 in k_marg.marginals)
+    assert k_marg.score_error <= 20
+    assert k_marg.score == groupby_score(target, deid, k_marg.marginals)
+
+    # all the pairs are scored when tolerance can not be reached
+    k_marg = KMarginal(target, deid, "PUMA", tolerance=0)
+    k_marg.compute_score()
+    assert len(k_marg.marginals) == 30 * 29 / 2
+    assert k_marg.score_error == 0
+
+    # no sampling error without tolerance
+    k_marg = KMarginal(target, deid)
+    k_marg.compute_score()
+    assert k_marg.score_error is None
+
+
+def test_adaptive_parallel_workers(make_data):
+    target, deid = make_data(5000, 0), make_data(3000, 1)
+    for i in range(26):
+        target[f"X{i}"] = target["AGEP"].values[np.random.default_rng(i).permutation(5000)]
+        deid[f"X{i}"] = deid["EDU"].values[np.random.default_rng(i).permutation(3000)]
+    k_marg = KMarginal(target, deid, "PUMA", tolerance=5)
+    k_marg.compute_score()
+    assert len(k_marg.marginals) > KMarginal.MIN_SAMPLED_MARGINALS
+
+    # the codes are shared, and the workers started, once for all the batches
+    with mock.patch.object(kmarginal, "share_codes",
+                           wraps=kmarginal.share_codes) as share_codes:
+        p_k_marg = KMarginal(target, deid, "PUMA", n_jobs=2, tolerance=5)
+        p_k_marg.compute_score()
+    assert share_codes.call_count == 2  # target and deidentified codes
+    assert p_k_marg.marginals == k_marg.marginals
+    assert p_k_marg.score == k_marg.score
+    assert p_k_marg.scores.equals(k_marg.scores)
+
+
+def test_given_marginals(make_data):
+    target, deid = make_data(5000, 0), make_data(3000, 1)
+    for i in range(26):
+        target[f"X{i}"] = target["AGEP"].values[np.random.default_rng(i).permutation(5000)]
+        deid[f"X{i}"] = deid["EDU"].values[np.random.default_rng(i).permutation(3000)]
+    a_k_marg = KMarginal(target, deid, "PUMA", tolerance=20)
+    a_k_marg.compute_score()
+    marginals = a_k_marg.marginals
+    # scores of given marginals are those of the adaptively sampled ones
+    k_marg = KMarginal(target, deid, "PUMA", marginals=marginals)
+    k_marg.compute_score()
+    assert k_marg.score == a_k_marg.score
+    assert k_marg.scores.equals(a_k_marg.scores)
+
+    # subsample baselines on the same marginals
+    rows = np.random.default_rng(0).choice(5000, size=2000, replace=False)
+    s_k_marg = SubsampleKMarginal(target, [rows], "PUMA", marginals=marginals)
+    s_k_marg.compute_score()
+    assert s_k_marg.marginals == marginals
+    k_marg = KMarginal(target, target.iloc[rows], "PUMA", marginals=marginals)
+    k_marg.compute_score()
+    assert s_k_marg.score[0] == k_marg.score
+
+    # group features of a multi-group score with given marginals
+    sex_marginals = [m for m in get_marginals(
+        sorted(set(target.columns) - {"SEX"}), 2, 50, 0)]
+    m_k_marg = MultiGroupKMarginal(target, deid, ["SEX", "INDP"],
+                                   group_marginals={"SEX": sex_marginals})
+    m_k_marg.compute_score()
+    k_marg = KMarginal(target, deid, "SEX", marginals=sex_marginals)
+    k_marg.compute_score()
+    assert m_k_marg.score["SEX"] == k_marg.score
+    assert m_k_marg.scores["SEX"].equals(k_marg.scores)
+    k_marg = KMarginal(target, deid, "INDP")
+    k_marg.compute_score()
+    assert m_k_marg.score["INDP"] == k_marg.score
+
+
+def test_subsample_scores(make_data):
+    target = make_data(5000, 0)
+    rng = np.random.default_rng(0)
+    subsamples = [rng.choice(5000, size=n, replace=False) for n in (50, 500, 2000)]
+    for group_feature in [None, "PUMA"]:
+        s_k_marg = SubsampleKMarginal(target, subsamples, group_feature)
+        s_k_marg.compute_score()
+        for i, rows in enumerate(subsamples):
+            k_marg = KMarginal(target, target.iloc[rows], group_feature)
+            k_marg.compute_score()
+            assert s_k_marg.score[i] == k_marg.score
+            if group_feature:
+                assert np.array_equal(s_k_marg.scores[i].values, k_marg.scores.values)
+
+
+def test_subsample_baseline(make_data, tmp_path: Path):
+    target = make_data(5000, 0)
+    subsample_scores = kmarginal_subsamples(target, "PUMA")
+    sf_scores = kmarginal_stable_feature_subsamples(target, "PUMA")
+    # subsamples are seeded, baselines are reproducible
+    assert kmarginal_subsamples(target, "PUMA") == subsample_scores
+    assert kmarginal_stable_feature_subsamples(target, "PUMA").equals(sf_scores)
+
+    path = baseline_path(tmp_path, "target", target, "PUMA", 0)
+    assert path.parent == tmp_path
+    assert load_baseline(path) is None
+    save_baseline(path, subsample_scores, sf_scores)
+    l_subsample_scores, l_sf_scores = load_baseline(path)
+    assert l_subsample_scores == subsample_scores
+    assert l_sf_scores.equals(sf_scores)
+    # the baseline is moved in place, no temporary file is left
+    assert list(tmp_path.iterdir()) == [path]
+    # baselines of other seeds or target data are saved separately
+    assert baseline_path(tmp_path, "target", target, "PUMA", 1) != path
+    assert baseline_path(tmp_path, "target", make_data(5000, 1), "PUMA", 0) != path
+
+    # partly written or malformed baselines are recomputed
+    text = path.read_text()
+    for corrupt in [text[:len(text) // 2], "[]", '{"subsample_scores": {"a": 1}}']:
+        path.write_text(corrupt)
+        assert load_baseline(path) is None
+
+
+def test_baseline_target(make_data):
+    data_dict = {"PUMA": {"values": {v: v for v in COLUMNS["PUMA"]}},
+                 "AGEP": {"values": {"min": 0, "max": 99}},
+                 "SEX": {"values": {"1": "Male", "2": "Female"}},
+                 "EDU": {"values": {str(v): v for v in COLUMNS["EDU"]}},
+                 "INDP": {"values": {str(v): v for v in COLUMNS["INDP"]}}}
+    target, deid = make_data(5000, 0), make_data(3000, 1)
+    b_target = baseline_target(target, data_dict)
+    # bins of the report's target depend on the deidentified data range,
+    # those of the baseline target only on the target data
+    assert bin_data(target, deid, data_dict)[0].equals(b_target)
+    deid.loc[:10, "AGEP"] = 60
+    assert not bin_data(target, deid, data_dict)[0].equals(b_target)
+
+
+if __name__ == "__main__":
+    make_data = data_factory(COLUMNS)
+    test_score_matches_groupby(make_data)
+    test_grouped_scores(make_data)
+    test_target_cache(make_data)
+    test_parallel_scores(make_data)
+    test_multi_group_scores(make_data)
+    test_multi_group_sampled_pairs(make_data)
+    test_higher_order_scores(make_data)
+    test_sampled_marginals()
+    test_streaming_scores(make_data)
+    test_adaptive_sampling(make_data)
+    test_adaptive_parallel_workers(make_data)
+    test_given_marginals(make_data)
+    test_subsample_scores(make_data)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_subsample_baseline(make_data, Path(tmp_dir))
+    test_baseline_target(make_data)
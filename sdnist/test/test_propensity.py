@@ -0,0 +1,125 @@
+import math
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sdnist.metrics.propensity import PropensityMSE
+
+
+COLUMNS = {"PUMA": range(0, 20),
+           "AGEP": range(0, 90),
+           "SEX": range(1, 3),
+           "EDU": range(-1, 12),
+           "INDP": [-1, 170, 770, 8570, 9920]}
+
+
+def reference_distribution(syn_prob: np.ndarray, indicator: np.ndarray,
+                           bins: int = 100) -> pd.DataFrame:
+    # reference implementation binning one record at a time
+    oc, sc = [0] * bins, [0] * bins
+    for p, i in zip(syn_prob, indicator):
+        pi = math.floor(round(p, 2) * bins)
+        pi = pi - 1 if pi == bins else pi
+        if i == 0:
+            oc[pi] += 1
+        else:
+            sc[pi] += 1
+    return pd.DataFrame([[o, s] for o, s in zip(oc, sc)],
+                        columns=['Target samples', 'Deid. samples'],
+                        index=range(bins))
+
+
+def test_propensity_distribution(make_data, tmp_path: Path):
+    target, deid = make_data(3000, 0), make_data(2000, 1)
+    p = PropensityMSE(target, deid, tmp_path)
+    rng = np.random.default_rng(0)
+    # probabilities on the rounding boundaries of the bins
+    syn_prob = np.concatenate([rng.random(5000), np.arange(0, 1001) / 1000,
+                               np.arange(0, 101) / 100 + 0.005, [0.0, 1.0]])
+    syn_prob = syn_prob[syn_prob <= 1]
+    indicator = rng.integers(0, 2, size=len(syn_prob))
+    assert p.propensity_distribution(syn_prob, indicator)\
+        .equals(reference_distribution(syn_prob, indicator))
+
+
+def test_pmse(make_data, tmp_path: Path):
+    target, deid = make_data(3000, 0), make_data(2000, 1)
+    deid["AGEP"] = deid["AGEP"] // 2
+    p = PropensityMSE(target, deid, tmp_path)
+    p.compute_score()
+    assert 0 < p.score <= 0.25
+    assert p.prob_dist['Target samples'].sum() == 3000
+    assert p.prob_dist['Deid. samples'].sum() == 2000
+    assert Path(tmp_path, p.report_data["propensity_distribution"]).exists()
+
+
+def test_training_data(make_data, tmp_path: Path):
+    target, deid = make_data(3000, 0), make_data(2000, 1)
+    # integer values held in object columns, as in the transformed datasets
+    target["AGEP"] = target["AGEP"].astype(object)
+    p = PropensityMSE(target, deid, tmp_path)
+    X, i = p.training_data(p.target, p.synthetic)
+    assert X.dtype == np.float32
+    assert np.array_equal(X, np.vstack([target.values, deid.values]).astype(np.float32))
+    assert np.array_equal(i, [0] * 3000 + [1] * 2000)
+
+
+def test_cross_validated_pmse(make_data, tmp_path: Path):
+    target, deid = make_data(3000, 0), make_data(2000, 1)
+    deid["AGEP"] = deid["AGEP"] // 2
+    for classifier in ["tree", "hist_gradient_boosting"]:
+        scores = []
+        for n_jobs in [1, 2]:
+            p = PropensityMSE(target, deid, tmp_path, classifier=classifier,
+                              n_folds=5, n_jobs=n_jobs)
+            p.compute_score()
+            scores.append(p.score)
+            assert p.report_data["classifier"] == classifier
+            assert p.report_data["n_folds"] == 5
+            assert p.prob_dist.values.sum() == 5000
+        # folds and classifiers are seeded, parallel folds give the same propensities
+        assert scores[0] == scores[1]
+        assert all(0 < s <= 0.25 for s in scores)
+
+
+def test_unknown_classifier(make_data, tmp_path: Path):
+    target, deid = make_data(300, 0), make_data(200, 1)
+    with pytest.raises(ValueError):
+        PropensityMSE(target, deid, tmp_path, classifier="svm")
+
+
+def test_subsampled_pmse(make_data, tmp_path: Path):
+    target, deid = make_data(30000, 0), make_data(20000, 1)
+    deid["AGEP"] = deid["AGEP"] // 2
+    p = PropensityMSE(target, deid, tmp_path)
+    p.compute_score()
+    s_p = PropensityMSE(target, deid, tmp_path, max_rows=10000)
+    s_p.compute_score()
+    assert s_p.sampling_fraction == 0.2
+    # same share of target and deidentified records as the full data
+    assert s_p.prob_dist['Target samples'].sum() == 6000
+    assert s_p.prob_dist['Deid. samples'].sum() == 4000
+    assert s_p.report_data["sampling_fraction"] == 0.2
+    assert 0 < s_p.pmse_spread == s_p.report_data["pmse_spread"]
+    # classifiers refitted on other subsamples score close to the subsample
+    assert len(s_p.subsample_pmses) == 10
+    assert len(set(s_p.subsample_pmses)) == 10
+    assert abs(np.mean(s_p.subsample_pmses) - s_p.score) < s_p.pmse_spread
+    assert abs(s_p.score - p.score) < 0.1 * p.score
+
+    # subsamples are seeded
+    s_p2 = PropensityMSE(target, deid, tmp_path, max_rows=10000, n_jobs=2)
+    s_p2.compute_score()
+    assert s_p2.score == s_p.score
+    assert s_p2.subsample_pmses == s_p.subsample_pmses
+
+    # no subsample when the data has less than max_rows records
+    f_p = PropensityMSE(target, deid, tmp_path, max_rows=100000)
+    f_p.compute_score()
+    assert f_p.sampling_fraction == 1
+    # no spread without subsampling
+    assert f_p.pmse_spread is None and "pmse_spread" not in f_p.report_data
+    assert f_p.prob_dist.values.sum() == 50000
+    assert p.pmse_spread is None and "sampling_fraction" not in p.report_data
@@ -0,0 +1,74 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+import sdnist.metrics.unique_exact_matches as uem
+from sdnist.metrics.unique_exact_matches import \
+    unique_exact_matches, row_keys, StreamingUniqueExactMatches
+from sdnist.test.conftest import data_factory
+
+
+COLUMNS = {"AGEP": range(0, 6),
+           "SEX": range(1, 3),
+           "EDU": range(-1, 4),
+           "PUMA": ["01-01301", "06-07502", "17-03529"]}
+DTYPES = {"EDU": float}
+
+
+def reference_unique_exact_matches(td: pd.DataFrame, dd: pd.DataFrame):
+    # reference implementation with pandas duplicated and merge
+    cols = td.columns.tolist()
+    u_td = td[~td.duplicated(keep=False)]
+    merged = u_td.merge(dd.drop_duplicates(subset=cols), how='inner', on=cols)
+    t_unique_records = u_td.shape[0]
+    perc_t_rec_matched = round(merged.shape[0] / t_unique_records * 100, 2) \
+        if t_unique_records > 0 else 0
+    return merged.shape[0], perc_t_rec_matched, \
+        t_unique_records, round(t_unique_records / td.shape[0] * 100, 2)
+
+
+def test_unique_exact_matches(make_data):
+    td, dd = make_data(2000, 0), make_data(1500, 1)
+    dd = pd.concat([dd, td.iloc[:300]], ignore_index=True)  # copied target records
+    td.loc[:50, "EDU"] = np.nan
+    dd.loc[1500:1520, "EDU"] = np.nan
+    dd["AGEP"] = dd["AGEP"].astype(float)  # same values, other dtype
+    assert unique_exact_matches(td, dd) == reference_unique_exact_matches(td, dd)
+    assert unique_exact_matches(td, dd)[0] > 0
+
+
+def test_streaming_unique_exact_matches(make_data):
+    td, dd = make_data(2000, 0), make_data(1500, 1)
+    dd = pd.concat([dd, td.iloc[:300]], ignore_index=True)
+    td.loc[:50, "EDU"] = np.nan
+    dd.loc[1500:1520, "EDU"] = np.nan
+    csv = io.StringIO()
+    dd.to_csv(csv, index=False)
+    csv.seek(0)
+    s_uem = StreamingUniqueExactMatches(td)
+    # chunks without missing values read EDU as int, other chunks as float
+    for chunk in pd.read_csv(csv, chunksize=400):
+        s_uem.update(chunk)
+    assert s_uem.finalize() == reference_unique_exact_matches(td, dd)
+
+
+def test_fingerprint_collisions(make_data, monkeypatch):
+    td, dd = make_data(500, 0), make_data(300, 1)
+    expected = reference_unique_exact_matches(td, dd)
+    # rows are keyed exactly when different rows have equal fingerprints
+    monkeypatch.setattr(uem, "row_fingerprints",
+                        lambda df, dtypes: np.zeros(df.shape[0], dtype=np.uint64))
+    keys = row_keys([td, dd], td.columns.tolist())
+    assert (pd.factorize(keys)[0] ==
+            pd.MultiIndex.from_frame(pd.concat([td, dd])).factorize()[0]).all()
+    assert unique_exact_matches(td, dd) == expected
+    s_uem = StreamingUniqueExactMatches(td)
+    s_uem.update(dd)
+    assert s_uem.finalize() == expected
+
+
+if __name__ == "__main__":
+    make_data = data_factory(COLUMNS, DTYPES)
+    test_unique_exact_matches(make_data)
+    test_streaming_unique_exact_matches(make_data)